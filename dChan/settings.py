@@ -124,6 +124,11 @@ CELERY_ACCEPT_CONTENT = ['application/json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'America/Los_Angeles'
+# Jobs claimed per scrape_posts run for each spider, and how long a claim lasts before the jobs can be claimed again
+SCRAPE_8KUN_BATCH_SIZE = config('SCRAPE_8KUN_BATCH_SIZE', default=25, cast=int)
+SCRAPE_ARCHIVE_IS_BATCH_SIZE = config('SCRAPE_ARCHIVE_IS_BATCH_SIZE', default=5, cast=int)
+SCRAPE_JOB_LEASE_SECONDS = config('SCRAPE_JOB_LEASE_SECONDS', default=60 * 60, cast=int)
+
 CELERY_BEAT_SCHEDULE = {
     'scrape-posts': {
         'task': 'posts.tasks.scrape_posts',
@@ -133,9 +138,9 @@ CELERY_BEAT_SCHEDULE = {
         'task': 'posts.tasks.create_scrape_jobs',
         'schedule': 10 * 60,
     },
-    'revisit-recent-threads': {
-        'task': 'posts.tasks.revisit_recent_threads',
-        'schedule': 60 * 60,
+    'schedule-revisits': {
+        'task': 'posts.tasks.schedule_revisits',
+        'schedule': 5 * 60,
     },
     'sync-elasticsearch': {
         'task': 'posts.tasks.sync_elasticsearch',
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
-from posts.models import Post, ScrapeJob, Board, Platform, RedditPost, Subreddit, TextboardPost
+from posts.models import Post, ScrapeJob, Board, Platform, RedditPost, Subreddit, TextboardPost, IngestManifest, \
+    ThreadState, PostLink
 
 admin.site.register(Post)
 admin.site.register(ScrapeJob)
@@ -9,3 +10,6 @@ admin.site.register(Board)
 admin.site.register(RedditPost)
 admin.site.register(Subreddit)
 admin.site.register(TextboardPost)
+admin.site.register(IngestManifest)
+admin.site.register(ThreadState)
+admin.site.register(PostLink)
@@ -4,3 +4,21 @@ from django.db import models
 class JobType(models.TextChoices):
     NEW = 'NEW'
     REVISIT = 'REV'
+
+
+class JobSource(models.TextChoices):
+    EIGHTKUN = '8KN'
+    ARCHIVE_IS = 'AIS'
+
+
+class IngestStatus(models.TextChoices):
+    IN_PROGRESS = 'IP'
+    COMPLETE = 'C'
+
+
+class ThreadStatus(models.TextChoices):
+    ACTIVE = 'ACT'
+    SLOWING = 'SLW'
+    BUMP_LOCKED = 'BMP'
+    ARCHIVED = 'ARC'  # Gone from the site
+    DEAD = 'DED'  # No new posts in a long time
@@ -0,0 +1,219 @@
+import contextlib
+import glob
+import io
+import json
+import os
+import time
+import tracemalloc
+
+import pandas as pd
+from django.core.management import BaseCommand, CommandError
+from django.db import transaction
+from django_elasticsearch_dsl import Document
+from tqdm import tqdm
+
+from posts import utilities
+from posts.management.commands.load_chan_data import parse_chan_frame
+from posts.management.commands.load_reddit_data import prepare_reddit_frame
+from posts.management.commands.load_textboard_data import commit_textboard_posts_from_df, prepare_textboard_frame
+
+
+@contextlib.contextmanager
+def rolled_back():
+    """
+    Run DB commits inside a transaction that is always rolled back, with Elasticsearch updates switched off so nothing
+    gets indexed that isn't in the DB. Rows that already exist are skipped by the commits as usual.
+    """
+    update = Document.update
+    Document.update = lambda self, *args, **kwargs: None
+    try:
+        with transaction.atomic():
+            yield
+            transaction.set_rollback(True)
+    finally:
+        Document.update = update
+        utilities.dimensions.clear()
+
+
+def run_stage(func, inputs, repeat):
+    """
+    Time func(inputs) on fresh copies of the inputs, keeping the best of `repeat` runs, then measure its peak memory
+    in a separate run under tracemalloc (which slows Python down too much to time with). Returns the last result
+    along with the seconds and peak bytes.
+    """
+    def copy(value):
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            return value.copy()
+        if isinstance(value, list):
+            return [copy(element) for element in value]
+        return value
+
+    # Silence the stages' own prints and progress bars
+    quiet = contextlib.ExitStack()
+    quiet.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    quiet.enter_context(contextlib.redirect_stderr(io.StringIO()))
+    with quiet:
+        seconds = None
+        for _ in range(repeat):
+            data = copy(inputs)
+            start = time.perf_counter()
+            result = func(data)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+        data = copy(inputs)
+        tracemalloc.start()
+        try:
+            func(data)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+def read_files(pattern, **kwargs):
+    files = sorted(glob.glob(pattern))
+    return [pd.read_csv(file, **kwargs) for file in files]
+
+
+class Command(BaseCommand):
+    help = "Benchmark each stage of the data loaders on the files in data/, report rows/sec and peak memory per " \
+           "stage, and compare them against a stored baseline. DB commits are always rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help='Time each stage this many times and keep the best')
+        parser.add_argument('--baseline', default='ingest_baseline.json', help='JSON file of baseline results')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help='Store this run as the baseline instead of comparing against it')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='Flag a regression if rows/sec falls or peak memory grows by more than this fraction')
+
+    def handle(self, *args, **options):
+        tqdm.pandas()
+        self.repeat = options['repeat']
+        self.results = {}
+        self.failures = {}  # Stage -> the error it raised
+
+        self.benchmark_chan('8chan')
+        self.benchmark_chan('8kun')
+        self.benchmark_textboards()
+        self.benchmark_reddit()
+
+        if not self.results and not self.failures:
+            raise CommandError('No data to benchmark. Expected CSV files in data/8chan, data/8kun, data/bbspink, '
+                               'data/2ch or data/reddit.')
+
+        if options['save_baseline']:
+            if self.failures:
+                raise CommandError(f'Not saving a baseline with failed stages: {", ".join(self.failures)}')
+            with open(options['baseline'], 'w') as f:
+                json.dump(self.results, f, indent=2)
+            print(f'Saved baseline to {options["baseline"]}')
+            return
+
+        baseline = {}
+        if os.path.exists(options['baseline']):
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+        else:
+            print(f'No baseline at {options["baseline"]}. Store one with --save-baseline.')
+
+        regressions = []
+        print(f'{"Stage":<40} {"Rows":>8} {"Rows/sec":>12} {"Peak MiB":>9} {"vs baseline":>24}')
+        for stage, result in self.results.items():
+            line = f'{stage:<40} {result["rows"]:>8} {result["rows_per_sec"]:>12.1f} {result["peak_mib"]:>9.1f}'
+            if stage in baseline:
+                speed = result['rows_per_sec'] / baseline[stage]['rows_per_sec'] - 1
+                memory = result['peak_mib'] / max(baseline[stage]['peak_mib'], 0.1) - 1
+                line += f' {speed:>+11.0%} {memory:>+7.0%} mem'
+                if speed < -options['tolerance'] or memory > options['tolerance']:
+                    line += '  REGRESSION'
+                    regressions.append(stage)
+            print(line)
+        for stage, error in self.failures.items():
+            print(f'{stage:<40} FAILED: {error}')
+            regressions.append(stage)
+        # A stage in the baseline that didn't run (because it failed, a stage before it did, or its data is gone) can't
+        # be shown to be no slower
+        for stage in baseline:
+            if stage not in self.results and stage not in self.failures:
+                print(f'{stage:<40} MISSING from this run')
+                regressions.append(stage)
+
+        if regressions:
+            raise CommandError(f'Regressions in: {", ".join(regressions)}')
+
+    def stage(self, name, func, inputs, rows):
+        """Benchmark one stage and record its results, or its error if it fails. Returns its output, or None."""
+        if not rows:
+            return None
+        try:
+            result, seconds, peak = run_stage(func, inputs, self.repeat)
+        except Exception as e:
+            print(f'{name} failed: {e!r}')
+            self.failures[name] = repr(e)
+            return None
+        self.results[name] = {'rows': rows, 'seconds': seconds, 'rows_per_sec': rows / max(seconds, 1e-9),
+                              'peak_mib': peak / 2 ** 20}
+        return result
+
+    def benchmark_chan(self, platform):
+        frames = read_files(f'data/{platform}/*.csv')
+        if not frames:
+            return
+        raw = pd.concat(frames, ignore_index=True)
+        is_archive_is = platform == '8chan' and raw['board'].iloc[0] != 'qresearch'
+
+        if is_archive_is:
+            self.stage(f'{platform} parse_archive_is_headers', utilities.parse_archive_is_headers, raw, len(raw))
+
+        # The later stages start from what the loader hands them, with nothing already archived
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            parsed = parse_chan_frame(raw.copy(), platform)
+        if parsed is None:
+            return
+        rows = len(parsed)
+        html = parsed.assign(body_text=parsed.body_html)
+
+        self.stage(f'{platform} process_links_from_df', utilities.process_links_from_df, html, rows)
+        formatter = utilities.lxml_parse_8chan_formatting if is_archive_is else utilities.lxml_parse_formatting
+        self.stage(f'{platform} {formatter.__name__}', lambda bodies: bodies.apply(formatter), html.body_text, rows)
+        self.stage(f'{platform} process_replies_from_df', utilities.process_replies_from_df,
+                   parsed.drop(columns=['index', 'replies']), rows)
+
+        def commit(df):
+            with rolled_back():
+                utilities.commit_posts_from_df(df, utilities.dimensions.platform(platform))
+
+        self.stage(f'{platform} commit_posts_from_df', commit, parsed, rows)
+
+    def benchmark_textboards(self):
+        for platform in ['2ch', 'bbspink']:
+            frames = read_files(f'data/{platform}/*.tsv', sep='\t')
+            rows = sum(len(df) for df in frames)
+            prepared = self.stage(f'{platform} prepare_textboard_frame',
+                                  lambda dfs: [prepare_textboard_frame(df) for df in dfs], frames, rows)
+            if prepared is None:
+                continue
+
+            def commit(dfs, platform=platform):
+                with rolled_back():
+                    for df in dfs:
+                        commit_textboard_posts_from_df(df, platform, df.loc[0].board)
+
+            self.stage(f'{platform} commit_textboard_posts_from_df', commit, prepared, rows)
+
+    def benchmark_reddit(self):
+        frames = read_files('data/reddit/*.csv', dtype=str)
+        rows = sum(len(df) for df in frames)
+        prepared = self.stage('reddit prepare_reddit_frame', lambda dfs: [prepare_reddit_frame(df) for df in dfs],
+                              frames, rows)
+        if prepared is None:
+            return
+
+        def commit(dfs):
+            with rolled_back():
+                for df in dfs:
+                    utilities.commit_reddit_posts_from_df(df)
+
+        self.stage('reddit commit_reddit_posts_from_df', commit, prepared, rows)
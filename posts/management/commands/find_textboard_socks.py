@@ -1,35 +1,52 @@
-from datetime import datetime
-
 import pandas as pd
 from django.core.management import BaseCommand
+from django.utils import timezone
 from tqdm import tqdm
-from pytz import timezone
 
 from posts.documents import TextboardPostDocument
-from posts.models import Board, Platform, TextboardPost
+from posts.models import Board, TextboardPost
+from posts.utilities import split_list
+
+# IDs shared by many posters, which say nothing about who wrote a post
+SHARED_POSTER_HASHES = ['???', '???0', 'CAP_USER', '']
+
+
+def find_socks(df):
+    """
+    Given a board's posts (id, thread_id, poster_hash, tripcode), return each post's sock_of: the tripcodes used by
+    its poster ID in the same thread if it has no tripcode itself (IDs are per thread), otherwise an empty list. An
+    empty tripcode counts as none.
+    """
+    trips = df[df.tripcode.fillna('') != ''].drop_duplicates(['thread_id', 'poster_hash', 'tripcode'])
+    tripcodes = trips.groupby(['thread_id', 'poster_hash']).tripcode.agg(sorted)
+
+    untripped = ~df.tripcode.astype(bool) & df.poster_hash.notna() & ~df.poster_hash.isin(SHARED_POSTER_HASHES)
+    matched = tripcodes.reindex(pd.MultiIndex.from_arrays([df.thread_id, df.poster_hash])).to_numpy()
+    return pd.Series([socks if is_sock and isinstance(socks, list) else [] for socks, is_sock in
+                      zip(matched, untripped)], index=df.index)
 
 
 class Command(BaseCommand):
     help = "Find posts which may be socks of trip posters"
 
     def handle(self, *args, **options):
-        TextboardPost.objects.update(sock_of=[])
-        thread_ids = TextboardPost.objects.values_list('thread_id', flat=True).distinct()
-        for thread in tqdm(thread_ids):
-            posts = TextboardPostDocument.search().query('match', thread_id=thread).extra(size=1000).to_queryset()
-            hashes_and_tripcodes = set(posts.values_list('poster_hash', 'tripcode'))
-            hash_tripcodes_map = dict()
-            for poster_hash, tripcode in hashes_and_tripcodes:
-                if tripcode is None:
-                    continue
-                if poster_hash not in hash_tripcodes_map:
-                    hash_tripcodes_map[poster_hash] = [tripcode]
-                else:
-                    hash_tripcodes_map[poster_hash].append(tripcode)
-
-            for post in posts:
-                if not post.tripcode:
-                    if post.poster_hash in hash_tripcodes_map:
-                        if post.poster_hash not in ['???', '???0', 'CAP_USER', '', None]:
-                            post.sock_of = hash_tripcodes_map[post.poster_hash]
-                            post.save()
+        changed_ids = []
+        for board in Board.objects.filter(textboard_posts__isnull=False).distinct():
+            print(f'Scanning {board}...')
+            posts = TextboardPost.objects.filter(board=board)
+            df = pd.DataFrame(posts.values_list('id', 'thread_id', 'poster_hash', 'tripcode', 'sock_of').iterator(),
+                              columns=['id', 'thread_id', 'poster_hash', 'tripcode', 'sock_of'])
+            df['new_sock_of'] = find_socks(df)
+            changed = df[[old != new for old, new in zip(df.sock_of, df.new_sock_of)]]
+
+            now = timezone.now()
+            updates = [TextboardPost(id=post_id, sock_of=sock_of, last_modified=now)
+                       for post_id, sock_of in zip(changed.id, changed.new_sock_of)]
+            TextboardPost.objects.bulk_update(updates, ['sock_of', 'last_modified'], batch_size=10000)
+            changed_ids.extend(changed.id)
+            print(f'Updated {len(updates)} of {len(df)} posts.')
+
+        print('Updating Elasticsearch index...')
+        for ids in tqdm(split_list(changed_ids, 10000)):
+            TextboardPostDocument().update(TextboardPost.objects.filter(id__in=ids))
+        print('Done!')
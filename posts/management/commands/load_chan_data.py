@@ -1,98 +1,159 @@
+import glob
+
 import pandas as pd
 from django.core.management import BaseCommand
 from tqdm import tqdm
 
 from posts import utilities
-from posts.models import Platform
-from posts.utilities import parse_archive_is, process_links, parse_8chan_formatting, parse_formatting, \
-    process_replies_from_df
+from posts.utilities import parse_archive_is_headers, process_links_from_df, lxml_parse_8chan_formatting, \
+    lxml_parse_formatting, process_replies_from_df
+
+# Set once per worker process by catalog_archived_posts() so it isn't pickled for every file
+already_archived = {}
+
+
+def catalog_archived_posts(archived):
+    global already_archived
+    already_archived = archived
+
+
+def read_chan_files(files, platform, chunksize=None, force=False):
+    """
+    Yield (DataFrame, platform, manifest, rows committed after it, whether it completes the file) tasks for
+    parse_chan_task, either one per file or in thread-aligned chunks. Files the ingest manifest records as loaded are
+    skipped and partly loaded ones resume after their last committed chunk. Each file ends with a task that has no
+    DataFrame, which marks it complete.
+    """
+    thread_column = 'thread_num' if platform == '4chan' else 'thread_no'
+    for file in files:
+        manifest = utilities.start_ingest(file, force)
+        if manifest is None:
+            continue
+        if chunksize:
+            chunks = utilities.read_csv_thread_chunks(file, thread_column, chunksize)
+        else:
+            chunks = [pd.read_csv(file)]
+
+        # Each chunk goes out as soon as it's read, so it's committed before the next one is read
+        rows = 0
+        for chunk in chunks:
+            rows += len(chunk)
+            if rows <= manifest.rows_committed:
+                continue
+            skip = max(manifest.rows_committed - (rows - len(chunk)), 0)
+            yield chunk.iloc[skip:], platform, manifest, rows, False
+        yield None, platform, manifest, rows, True
+
+
+def parse_chan_task(df, platform, manifest, rows, complete):
+    return manifest, rows, complete, None if df is None else parse_chan_frame(df, platform)
+
+
+def parse_chan_frame(df, platform):
+    """
+    Run every parsing step short of the DB commit on a file (or a thread-aligned chunk of one). Returns None if all
+    of its posts are already archived. Runs in worker processes when --workers > 1, so it must not touch the database.
+    """
+    if platform == '8chan' and df['board'].iloc[0] != 'qresearch':
+        # Scraped from archive.is
+        df, failures = parse_archive_is_headers(df)
+        if failures:
+            print(f'Skipped {sum(failures.values())} posts with unparseable archive.is headers: {dict(failures)}')
+        df['timestamp'] = pd.to_datetime(df['timestamp'])
+        df['timestamp'] = df['timestamp'].dt.tz_localize(tz='UTC')  # 8chan timestamps are UTC
+    elif platform == '4chan':
+        # Rename columns
+        df['thread_no'] = df['thread_num']
+        df['post_no'] = df['num']
+        df['poster_id'] = df['poster_hash']
+        df['subject'] = df['title']
+        df['body_text'] = df['comment']
+        df['tripcode'] = df['trip']
+        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
+        df['timestamp'] = df['timestamp'].dt.tz_localize(tz='UTC')  # 4plebs timestamps are UTC
+        df = df[['thread_no', 'post_no', 'poster_id', 'subject', 'body_text', 'tripcode', 'timestamp',
+                 'name', 'board']]
+
+    before = len(df)
+    df['post_no'] = df['post_no'].astype(str)
+    df['thread_no'] = df['thread_no'].astype(str)
+    df = df.drop_duplicates()
+    after = len(df)
+    if after - before > 0:
+        print(f'Dropped {after - before} duplicates...')
+    df['platform'] = platform
+    size_before = len(df)
+    # Remove if already archived
+    df = df[~utilities.archived_mask(already_archived, df['board'], df['post_no'])]
+    size_after = len(df)
+    df = df.reset_index()
+    saved = size_before - size_after
+    if size_after == 0:
+        print('Already archived all posts.')
+        return None
+    elif size_after != size_before:
+        print(f'Already archived {saved} of {size_before} posts.')
+
+    # Fill later-added body_html field
+    if platform != '4chan':
+        df['body_html'] = df.body_text
+    else:
+        df['body_html'] = ''
+
+    if platform != '4chan':  # No format or link info from 4plebs API
+        print('Processing links...')
+        df['links'] = process_links_from_df(df)[0]
+
+        print('Parsing HTML to imageboard markup...')
+        if platform == '8chan' and df['board'].loc[0] != 'qresearch':
+            df['body_text'] = df.body_text.progress_apply(lxml_parse_8chan_formatting)
+        else:
+            df['body_text'] = df.body_text.progress_apply(lxml_parse_formatting)
+    else:
+        df['links'] = df.body_text.apply(lambda x: dict())
+    df = df.fillna('')
+
+    # Process replies
+    return process_replies_from_df(df)
 
 
 class Command(BaseCommand):
     help = "Load data from CSV files scraped from Chan data. Expects three files, 4chan.csv, 8chan.csv, 8kun.csv"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes used to parse files while this process commits them to the DB')
+        parser.add_argument('--chunksize', type=int, default=None,
+                            help='Stream each file in chunks of about this many rows (whole threads are kept '
+                                 'together) and commit each chunk before reading the next, to bound memory use')
+        utilities.add_force_argument(parser)
+
     def handle(self, *args, **options):
         tqdm.pandas()
-        import glob
 
         for platform in ['4chan', '8chan', '8kun']:
             print(f'Loading {platform} data...')
-            platform_obj, created = Platform.objects.get_or_create(name=platform)
+            platform_obj = utilities.dimensions.platform(platform)
             print('Cataloging existing posts in DB...')
-            already_archived = set(f'{post[0]}/{post[1]}' for post in
-                                   platform_obj.posts.values_list('board__name', 'post_id'))
+            # 8chan posts are committed as 8kun posts
+            archived = utilities.catalog_post_ids(utilities.dimensions.platform('8kun') if platform == '8chan'
+                                                  else platform_obj)
             files = glob.glob(f'data/{platform}/*.csv')
             try:
-                for file in files:
-                    print(f'Loading {file}...')
-                    df = pd.read_csv(file)
-                    if platform == '8chan' and df['board'].loc[0] != 'qresearch':
-                        # Scraped from archive.is
-                        df = pd.DataFrame(list(df.apply(parse_archive_is, axis=1)))
-                        df['timestamp'] = pd.to_datetime(df['timestamp'])
-                        df['timestamp'] = df['timestamp'].dt.tz_localize(tz='UTC')  # 8chan timestamps are UTC
-                    elif platform == '4chan':
-                        # Rename columns
-                        df['thread_no'] = df['thread_num']
-                        df['post_no'] = df['num']
-                        df['poster_id'] = df['poster_hash']
-                        df['subject'] = df['title']
-                        df['body_text'] = df['comment']
-                        df['tripcode'] = df['trip']
-                        df['timestamp'] = pd.to_datetime(df['timestamp'], unit='s')
-                        df['timestamp'] = df['timestamp'].dt.tz_localize(tz='UTC')  # 4plebs timestamps are UTC
-                        df = df[['thread_no', 'post_no', 'poster_id', 'subject', 'body_text', 'tripcode', 'timestamp',
-                                 'name', 'board']]
-
-                    before = len(df)
-                    df['post_no'] = df['post_no'].astype(str)
-                    df['thread_no'] = df['thread_no'].astype(str)
-                    df = df.drop_duplicates()
-                    after = len(df)
-                    if after - before > 0:
-                        print(f'Dropped {after - before} duplicates...')
-                    df['id'] = df['board'] + '/' + df['post_no'].astype(str)
-                    df['platform'] = platform
-                    size_before = len(df)
-                    # Remove if already archived
-                    df = df[~df.id.isin(already_archived)]
-                    size_after = len(df)
-                    df = df.reset_index()
-                    saved = size_before - size_after
-                    if size_after == 0:
-                        print('Already archived all posts.')
-                        continue
-                    elif size_after != size_before:
-                        print(f'Already archived {saved} of {size_before} posts.')
-
-                    # Fill later-added body_html field
-                    if platform != '4chan':
-                        df['body_html'] = df.body_text
-                    else:
-                        df['body_html'] = ''
-
-                    if platform != '4chan':  # No format or link info from 4plebs API
-                        print('Processing links...')
-                        df['links'] = df.progress_apply(process_links, axis=1)
-
-                        print('Parsing HTML to imageboard markup...')
-                        if platform == '8chan' and df['board'].loc[0] != 'qresearch':
-                            df['body_text'] = df.body_text.progress_apply(parse_8chan_formatting)
-                        else:
-                            df['body_text'] = df.body_text.progress_apply(parse_formatting)
-                    else:
-                        df['links'] = df.body_text.apply(lambda x: dict())
-                    df = df.fillna('')
-
-                    # Process replies
-                    df = process_replies_from_df(df)
-
-                    print('Committing objects to database...')
-                    utilities.commit_posts_from_df(df, platform_obj)
+                # Files (or chunks) are parsed by a pool of workers and committed here, one at a time and in order,
+                # so the result is the same as loading them serially
+                tasks = read_chan_files(files, platform, options['chunksize'], options['force'])
+                parsed = utilities.pipelined_map(parse_chan_task, tasks, workers=options['workers'],
+                                                 initializer=catalog_archived_posts, initargs=(archived,))
+                for manifest, rows, complete, df in parsed:
+                    if df is not None:
+                        print('Committing objects to database...')
+                        utilities.commit_posts_from_df(df, platform_obj)
+                    # Commits skip posts already in the DB, so crashing before this only means redoing this chunk
+                    utilities.record_ingest_progress(manifest, rows, complete)
 
             except Exception as e:
                 print(f'Could not load {platform} data.', e)
                 raise e
 
         print('Done!')
-        print('Remember to re-generate SearchVectors with python manage.py process_search_vectors')
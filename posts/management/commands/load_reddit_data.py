@@ -2,82 +2,84 @@ import html
 
 import pandas as pd
 from django.core.management import BaseCommand
-from tqdm import tqdm
 
 from posts import utilities
 
 
+BOOL_COLUMNS = ['is_submitter', 'is_self', 'locked', 'over_18', 'stickied', 'no_follow']
+
+
+def unescape(values):
+    """html.unescape a Series of strings, only calling it on the ones that contain an entity."""
+    escaped = values.str.contains('&', regex=False)
+    return values.where(~escaped, values[escaped].map(html.unescape))
+
+
+def prepare_reddit_frame(df):
+    """
+    Turn a DataFrame read from a Reddit CSV (as strings) into the columns commit_reddit_posts_from_df expects, with
+    vectorized operations on whole columns.
+    """
+    df = df.mask(df == 'None')
+
+    if 'edited' not in df:
+        df['edited'] = None
+
+    for column in BOOL_COLUMNS:
+        df[column] = df[column].str.upper() == 'TRUE'
+    df['num_comments'] = pd.to_numeric(df['num_comments'], errors='coerce').fillna(0).astype('int64')
+    df['score'] = pd.to_numeric(df['score'], errors='coerce')
+
+    df['subreddit'] = df.subreddit.iloc[0]
+    df['is_op'] = df['item_type'] == 'submission'
+    df['edited'] = pd.to_datetime(pd.to_numeric(df['edited'], errors='coerce'), unit='s', utc=True)
+    df['created_utc'] = pd.to_datetime(df['created_utc'], utc=True)
+    df['scraped_on'] = pd.to_datetime(df['scraped_on'], utc=True)
+
+    # https://reddit.com/r/<subreddit>/comments/<thread hash>/<thread slug>/<comment ID>/
+    permalink = df.permalink.str.split('/')
+    is_comment = df['item_type'] == 'comment'
+    df['thread_hash'] = permalink.str[6]
+    df['thread_slug'] = permalink.str[7]
+    df['link_id'] = permalink.str[-2].where(is_comment, df.thread_hash)
+    df['parent_id'] = df.parent_id.str.split('_').str[-1].where(is_comment)
+
+    df['text'] = unescape(df.text.fillna('').astype(str))
+    df['title'] = unescape(df.title.fillna('').astype(str))
+    df['author_fullname'] = df.author_fullname.fillna('')
+    df = df.dropna(subset=['score', 'author'])
+    return df.astype(object).where(df.notna(), None)
+
+
 class Command(BaseCommand):
     help = "Load data from CSV files scraped from Reddit data."
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunksize', type=int, default=100000,
+                            help='Read, transform and commit each file in chunks of this many rows')
+        utilities.add_force_argument(parser)
+
     def handle(self, *args, **options):
-        tqdm.pandas()
         import glob
 
         files = glob.glob(f'data/reddit/*.csv')
         try:
             for file in files:
-                print(f'Loading {file}...')
-
-                def convert_bool(val):
-                    if not val:
-                        return False
-                    return val == 'TRUE'
-
-                def convert_int(val):
-                    if not val:
-                        return 0
-                    if isinstance(val, str):
-                        return int(float(val))
-                    return val
-
-                def process_link_id_and_parent(row):
-                    try:
-                        row['thread_hash'] = row['permalink'].split('/')[6]
-                        row['thread_slug'] = row['permalink'].split('/')[7]
-                        if row['item_type'] == 'comment':
-                            row['link_id'] = row['permalink'].split('/')[-2]
-                            row['parent_id'] = row['parent_id'].split('_')[-1]
-                        else:
-                            row['link_id'] = row['thread_hash']
-                            row['parent_id'] = None
-
-                        return row
-
-                    except Exception as e:
-                        print(row)
-                        print(e)
-
-                df = pd.read_csv(file, converters={'num_comments': convert_int, 'is_submitter': convert_bool,
-                                                   'is_self': convert_bool, 'locked': convert_bool,
-                                                   'over_18': convert_bool, 'stickied': convert_bool,
-                                                   'no_follow': convert_bool})
-                df = df.replace('None', None)
-
-                if 'edited' not in df:
-                    df['edited'] = None
-
-                df['subreddit'] = df.loc[0].subreddit
-                df['is_op'] = df['item_type'] == 'submission'
-                df['edited'] = pd.to_datetime(df['edited'], unit='s')
-                df['created_utc'] = pd.to_datetime(df['created_utc'])
-                df['created_utc'] = df['created_utc'].dt.tz_localize(tz='UTC')
-                df['edited'] = df['edited'].dt.tz_localize(tz='UTC')
-                df['scraped_on'] = pd.to_datetime(df['scraped_on'])
-                df['scraped_on'] = df['scraped_on'].dt.tz_localize(tz='UTC')
-                print('Processing data...')
-                df = df.progress_apply(process_link_id_and_parent, axis=1)
-                df['edited'] = df['edited'].astype(object).where(df['edited'].notnull(), None)
-                df['text'] = df.text.fillna('')
-                df['text'] = df.text.astype(str)
-                df['title'] = df.title.astype(str)
-                df['text'] = df.text.apply(html.unescape)
-                df['title'] = df.title.apply(html.unescape)
-                df['created_utc'] = df['created_utc'].astype(object).where(df['created_utc'].notnull(), None)
-                df = df.dropna(subset=['score', 'author', 'text'])
-
-                print('Committing objects to database...')
-                utilities.commit_reddit_posts_from_df(df)
+                manifest = utilities.start_ingest(file, options['force'])
+                if manifest is None:
+                    continue
+
+                rows = 0
+                for df in pd.read_csv(file, dtype=str, chunksize=options['chunksize']):
+                    rows += len(df)
+                    if rows <= manifest.rows_committed:
+                        continue
+                    df = df.iloc[max(manifest.rows_committed - (rows - len(df)), 0):]
+
+                    print(f'Committing rows up to {rows}...')
+                    utilities.commit_reddit_posts_from_df(prepare_reddit_frame(df))
+                    utilities.record_ingest_progress(manifest, rows)
+                utilities.record_ingest_progress(manifest, rows, complete=True)
 
         except Exception as e:
             print(f'Could not load Reddit data.', e)
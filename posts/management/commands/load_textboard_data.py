@@ -1,76 +1,92 @@
-from datetime import datetime
-
 import pandas as pd
 from django.core.management import BaseCommand
+from django.db import transaction
 from tqdm import tqdm
-from pytz import timezone
 
+from posts import utilities
 from posts.documents import TextboardPostDocument
-from posts.models import Board, Platform, TextboardPost
+from posts.models import TextboardPost
 
 
 class Command(BaseCommand):
     help = "Load data from CSV files scraped from textboard data."
 
+    def add_arguments(self, parser):
+        utilities.add_force_argument(parser)
+
     def handle(self, *args, **options):
         tqdm.pandas()
         import glob
 
-        for platform in ['2ch', 'bbspink']:
-            files = glob.glob(f'data/{platform}/*.tsv')
-            try:
-                for file in files:
-                    print(f'Loading {file}...')
-
-                    df = pd.read_csv(file, sep='\t')
-                    df = df.astype(object).where(pd.notnull(df), None)
-                    df['author'] = df.author.where(pd.notnull(df.author), '')
-                    df['body'] = df.body.where(pd.notnull(df.body), '')
-                    board_name = df.loc[0].board
-
-                    print('Committing objects to database...')
-                    commit_textboard_posts_from_df(df, platform, board_name)
-
-            except Exception as e:
-                print(f'Could not load BBSPink data.', e)
-                raise e
-
-            print('Updating Elasticsearch index...')
-            TextboardPostDocument().update(TextboardPost.objects.all())
-            print('Done!')
+        # Only the posts actually inserted are indexed, on a background thread while loading goes on
+        with utilities.BackgroundIndexer(TextboardPostDocument) as indexer:
+            for platform in ['2ch', 'bbspink']:
+                files = glob.glob(f'data/{platform}/*.tsv')
+                try:
+                    for file in files:
+                        manifest = utilities.start_ingest(file, options['force'])
+                        if manifest is None:
+                            continue
+
+                        df = prepare_textboard_frame(pd.read_csv(file, sep='\t'))
+                        board_name = df.loc[0].board
+
+                        print('Committing objects to database...')
+                        # Textboard posts have no unique key to skip them by, so only the rows not yet committed go in
+                        commit_textboard_posts_from_df(df.iloc[manifest.rows_committed:], platform, board_name, indexer,
+                                                       manifest)
+                        utilities.record_ingest_progress(manifest, len(df), complete=True)
+
+                except Exception as e:
+                    print(f'Could not load {platform} data.', e)
+                    raise e
+
+            print('Waiting for Elasticsearch index updates...')
+        print('Done!')
+
+
+def prepare_textboard_frame(df):
+    df = df.astype(object).where(pd.notnull(df), None)
+    df['author'] = df.author.where(pd.notnull(df.author), '')
+    df['body'] = df.body.where(pd.notnull(df.body), '')
+    return df
+
+
+def commit_textboard_posts_from_df(df, platform_name, board_name, indexer=None, manifest=None):
+    """
+    Commit the posts in batches, handing the IDs of the ones actually inserted to `indexer` (a BackgroundIndexer)
+    after each batch if given. With an ingest `manifest`, each batch's rows are recorded as committed along with it.
+    Returns all of the inserted IDs.
+    """
+    platform = utilities.dimensions.platform(platform_name)
+    board = utilities.dimensions.board(platform, board_name)
+
+    # Dates are JST, e.g. 2004-05-02 11:52:00. A malformed one raises, as it should
+    dates = pd.to_datetime(df['date'], format='%Y-%m-%d %H:%M:%S').dt.tz_localize('Asia/Tokyo')
+    df = df.assign(timestamp=dates.astype(object).where(dates.notnull(), None),
+                   is_op=pd.to_numeric(df['post_no']) == 1)
 
-
-def commit_textboard_posts_from_df(df, platform_name, board_name):
     new_posts = []
-
-    platform, created = Platform.objects.get_or_create(name=platform_name)
-    board, created = Board.objects.get_or_create(name=board_name, platform=platform)
-
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        jst = timezone('Asia/Tokyo')
-        if type(row['date']) != str:
-            date = None
-        else:
-            try:
-                date = jst.localize(datetime.strptime(row['date'], '%Y-%m-%d %H:%M:%S'))
-            except Exception as e:
-                print('Failed on date')
-                print(row['date'])
-                raise
-
+    posts_ids = []
+    for row in tqdm(df.to_dict('records')):
         post = TextboardPost(platform=platform, board=board, thread_id=row['thread_no'], post_id=row['post_no'],
                              author=row['author'], email=row['email'], poster_hash=row['user_id'], subject=row['subject'],
-                             body=row['body'], timestamp=date, tripcode=row['tripcode'], capcode=row['capcode'],
-                             is_op=int(row['post_no']) == 1)
-
+                             body=row['body'], timestamp=row['timestamp'], tripcode=row['tripcode'],
+                             capcode=row['capcode'], is_op=row['is_op'])
         new_posts.append(post)
-
-    # Source on ES bulk update pattern:
-    # https://github.com/django-es/django-elasticsearch-dsl/issues/32#issuecomment-736046572
-    try:
-        TextboardPost.objects.bulk_create(new_posts, ignore_conflicts=True)
-    except Exception as e:
-        print(e)
-        print('Failed on row:')
-        print(row)
-        raise e
+        if len(new_posts) >= 10000:
+            posts_ids.extend(commit_textboard_posts(new_posts, indexer, manifest))
+            new_posts = []
+
+    posts_ids.extend(commit_textboard_posts(new_posts, indexer, manifest))
+    return posts_ids
+
+
+def commit_textboard_posts(posts, indexer, manifest=None):
+    with transaction.atomic():
+        ids = [row[0] for row in utilities.copy_insert(posts)]
+        if manifest is not None:
+            utilities.record_ingest_progress(manifest, manifest.rows_committed + len(posts))
+    if indexer is not None:
+        indexer.add(ids)
+    return ids
@@ -1,40 +1,78 @@
 import re
 from django.core.management import BaseCommand
-from tqdm import tqdm
+from django.db.models import Q
 import pandas as pd
 
-from posts.models import Post, Platform, Board, Drop
-
-
-def mark_posts(row):
-    post = row['post_info']
-    try:
-        if post[0] == '4plebs.org':
-            platform = '4chan'
-        else:
-            platform = '8kun'
-
-        drop_board = Board.objects.get(platform__name=platform, name=post[1])
-        drop_post = Post.objects.get(platform__name=platform, board__name=drop_board.name, post_id=post[5])
-        drop, created = Drop.objects.get_or_create(post=drop_post, number=row['drop'])
-
-    except Exception:
-        # Drop is not yet archived
-        print(f"Missing drop #{row['drop']}...")
-        pass
+from posts.models import Post, Drop
 
 
 def extract_post_info(url):
     post = re.findall(
         r'(8ch\.net|8kun\.[a-z]+|4plebs\.org)\/([a-zA-Z0-9]+)\/(res|thread)\/([0-9]+)(\.html)?/?#q?([0-9]+)', url)
-    return post[0]
+    return post[0] if post else None
+
+
+def resolve_drops(drops):
+    """
+    Add `platform`, `board`, `post_id` and `post` (the archived Post's primary key, or NaN) columns to a drop number
+    -> URL map, resolving every URL with one query.
+    """
+    post_info = drops.url.apply(extract_post_info)
+    drops['platform'] = post_info.map(lambda post: None if post is None else '4chan' if post[0] == '4plebs.org'
+                                      else '8kun')
+    drops['board'] = post_info.str[1]
+    drops['post_id'] = pd.to_numeric(post_info.str[5]).astype('Int64')
+
+    query = Q(pk__in=[])
+    for (platform, board), group in drops.dropna(subset=['platform']).groupby(['platform', 'board']):
+        query |= Q(platform__name=platform, board__name=board, post_id__in=group.post_id.astype(int).tolist())
+    posts = pd.DataFrame(Post.objects.filter(query).values_list('platform__name', 'board__name', 'post_id', 'id'),
+                         columns=['platform', 'board', 'post_id', 'post'])
+    return drops.merge(posts, how='left', on=['platform', 'board', 'post_id'])
 
 
 class Command(BaseCommand):
     help = "Process Q drop number -> post URL map file and mark the drops with their drop numbers"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--map', default='missing_Q-Notebook_data.tsv', help='TSV of drop numbers and URLs')
+        parser.add_argument('--report', default='unresolved_drops.tsv',
+                            help='Where to write the drops that could not be marked, with the reason why')
+
     def handle(self, *args, **options):
-        map = pd.read_csv('missing_Q-Notebook_data.tsv', sep='\t')
-        tqdm.pandas()
-        map['post_info'] = map.url.apply(extract_post_info)
-        map.progress_apply(mark_posts, axis=1)
+        drops = resolve_drops(pd.read_csv(options['map'], sep='\t'))
+
+        # Drops already marked keep their posts; a number or post can only be marked once
+        marked_numbers = dict(Drop.objects.values_list('number', 'post_id'))
+        marked_posts = {post: number for number, post in marked_numbers.items()}
+        new_drops = []
+        reasons = []
+        for drop in drops.itertuples():
+            if pd.isna(drop.platform):
+                reasons.append('unparseable url')
+                continue
+            if pd.isna(drop.post):
+                reasons.append('not archived')
+                continue
+            post = int(drop.post)
+            if marked_numbers.get(drop.drop) == post:
+                reasons.append(None)
+            elif drop.drop in marked_numbers:
+                reasons.append('number already marked on another post')
+            elif post in marked_posts:
+                reasons.append('post already marked as another drop')
+            else:
+                marked_numbers[drop.drop] = post
+                marked_posts[post] = drop.drop
+                new_drops.append(Drop(post_id=post, number=drop.drop))
+                reasons.append(None)
+        Drop.objects.bulk_create(new_drops, ignore_conflicts=True)
+
+        drops['reason'] = reasons
+        unresolved = drops[drops.reason.notna()]
+        unresolved[['drop', 'url', 'platform', 'board', 'post_id', 'reason']].to_csv(options['report'], sep='\t',
+                                                                                      index=False)
+        print(f'Marked {len(new_drops)} new drops; {len(drops) - len(unresolved)} of {len(drops)} are marked.')
+        for reason, count in unresolved.reason.value_counts().items():
+            print(f'{count} {reason}')
+        print(f'Unresolved drops written to {options["report"]}')
@@ -1,16 +1,39 @@
-from csv import DictReader
 from django.core.management import BaseCommand
 from tqdm import tqdm
-import re
 
+from posts.documents import PostDocument
 from posts.models import Post, Platform
+from posts.utilities import resolve_post_links, save_post_links, split_list
 
 
 class Command(BaseCommand):
     help = "Process >>links and store their full URLs for fast retrieval"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Posts to resolve and update at once')
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Resume after this post ID, as printed by an interrupted run')
+
     def handle(self, *args, **options):
         fourch = Platform.objects.get(name='4chan')
-        posts = Post.objects.filter(platform=fourch)
-        for post in tqdm(posts):
-            post.process_links()
+        posts = Post.objects.filter(platform=fourch).only('platform', 'board', 'body', 'links').order_by('id')
+        after_id = options['after_id']
+        changed_ids = []
+        with tqdm(total=posts.filter(id__gt=after_id).count()) as progress:
+            while True:
+                batch = list(posts.filter(id__gt=after_id)[:options['batch_size']])
+                if not batch:
+                    break
+                changed = resolve_post_links(batch)
+                # bulk_update skips the save signal, so ES isn't updated once per post
+                Post.objects.bulk_update(changed, ['links', 'last_modified'])
+                save_post_links([(post.id, post.links) for post in changed])
+                changed_ids.extend(post.id for post in changed)
+                after_id = batch[-1].id
+                progress.update(len(batch))
+                progress.set_postfix(after_id=after_id)
+
+        print(f'Updated links of {len(changed_ids)} posts. Updating Elasticsearch index...')
+        for ids in split_list(changed_ids, options['batch_size']):
+            PostDocument().update(Post.objects.filter(id__in=ids))
+        print('Done!')
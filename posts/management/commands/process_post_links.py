@@ -0,0 +1,30 @@
+from django.core.management import BaseCommand
+from tqdm import tqdm
+
+from posts.models import Post
+from posts.utilities import save_post_links
+
+
+class Command(BaseCommand):
+    help = "Rebuild the PostLink rows of every post from its links. New posts get theirs when they're inserted, so " \
+           "this is only needed for posts loaded before PostLink existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000, help='Posts to rebuild links of at once')
+        parser.add_argument('--after-id', type=int, default=0,
+                            help='Resume after this post ID, as printed by an interrupted run')
+
+    def handle(self, *args, **options):
+        posts = Post.objects.exclude(links={}).order_by('id')
+        after_id = options['after_id']
+        links_saved = 0
+        with tqdm(total=posts.filter(id__gt=after_id).count()) as progress:
+            while True:
+                batch = list(posts.filter(id__gt=after_id).values_list('id', 'links')[:options['batch_size']])
+                if not batch:
+                    break
+                links_saved += len(save_post_links(batch))
+                after_id = batch[-1][0]
+                progress.update(len(batch))
+                progress.set_postfix(after_id=after_id)
+        print(f'Saved {links_saved} links. Done!')
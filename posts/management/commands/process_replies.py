@@ -1,12 +1,36 @@
+from datetime import datetime
+
 from django.core.management import BaseCommand
-from tqdm import tqdm
+from django.utils import timezone
 
 from posts.models import Post
-from posts.utilities import process_replies
+from posts.utilities import rebuild_replies
 
 
 class Command(BaseCommand):
     help = "Process replies to posts and store their full URLs for fast retrieval"
 
+    def add_arguments(self, parser):
+        parser.add_argument('--board', action='append',
+                            help='Only rebuild threads on this board (may be given more than once)')
+        parser.add_argument('--since', type=datetime.fromisoformat,
+                            help='Only rebuild threads with posts added or changed since this date (YYYY-MM-DD)')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes computing replies while this process reads and writes the DB')
+        parser.add_argument('--batch-size', type=int, default=500, help='Threads read and written at once')
+
     def handle(self, *args, **options):
-        process_replies()
+        posts = Post.objects.all()
+        if options['board']:
+            posts = posts.filter(board__name__in=options['board'])
+        if options['since']:
+            since = options['since']
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            posts = posts.filter(last_modified__gte=since)
+
+        print('Finding threads...')
+        threads = list(posts.order_by('board_id', 'thread_id').values_list('board_id', 'thread_id').distinct())
+        print(f'Rebuilding replies in {len(threads)} threads...')
+        updated = rebuild_replies(threads, workers=options['workers'], batch_size=options['batch_size'])
+        print(f'Updated replies of {updated} posts. Done!')
@@ -1,17 +1,50 @@
-from csv import DictReader
+from concurrent.futures import ThreadPoolExecutor
 
 from django.contrib.postgres.search import SearchVector
 from django.core.management import BaseCommand
+from django.db import connections
+from django.db.models import Max, Min
 from tqdm import tqdm
-import re
 
 from posts.models import Post
 
 
+def update_search_vectors(posts, start, end):
+    """Generate search vectors for the posts with start <= id < end. Each call commits on its own."""
+    try:
+        return posts.filter(id__gte=start, id__lt=end).update(search_vector=SearchVector('body'))
+    finally:
+        # Runs on a worker thread, which has its own DB connection
+        connections.close_all()
+
+
 class Command(BaseCommand):
-    help = "Create search vectors for performant full-text search."
+    help = "Create search vectors for performant full-text search. New and edited posts get theirs from a DB " \
+           "trigger, so this is only needed for posts loaded before it existed."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000,
+                            help='Posts (by ID range) updated per transaction')
+        parser.add_argument('--workers', type=int, default=1, help='Batches updated at once, each on a connection')
+        parser.add_argument('--all', action='store_true',
+                            help='Regenerate every vector rather than just the missing ones')
 
     def handle(self, *args, **options):
+        posts = Post.objects.all()
+        if not options['all']:
+            # Batches commit as they go, so an interrupted run resumes where it left off
+            posts = posts.filter(search_vector__isnull=True)
+        ids = posts.aggregate(start=Min('id'), end=Max('id'))
+        if ids['start'] is None:
+            print('All posts have search vectors.')
+            return
+
         print('Updating search vectors...')
-        Post.objects.update(search_vector=SearchVector('body'))
-        print('Done!')
+        batch_size = options['batch_size']
+        starts = range(ids['start'], ids['end'] + 1, batch_size)
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor, tqdm(total=len(starts)) as progress:
+            updated = 0
+            for count in executor.map(lambda start: update_search_vectors(posts, start, start + batch_size), starts):
+                updated += count
+                progress.update()
+        print(f'Updated {updated} posts. Done!')
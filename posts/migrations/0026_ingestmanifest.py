@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0025_remove_post_hidden_by_dchan'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('status', models.CharField(choices=[('IP', 'In Progress'), ('C', 'Complete')], default='IP', max_length=2)),
+                ('rows_committed', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ingestmanifest',
+            constraint=models.UniqueConstraint(fields=('path', 'size', 'content_hash'), name='unique_ingest_file'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:18
+
+import django.contrib.postgres.indexes
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    # Building the index concurrently doesn't block writes to posts, but can't run in a transaction
+    atomic = False
+
+    dependencies = [
+        ('posts', '0026_ingestmanifest'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='post',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='post_search_vector_gin'),
+        ),
+        # Keep search vectors current for new and edited posts; same as SearchVector('body')
+        migrations.RunSQL(
+            sql="""
+                CREATE FUNCTION posts_post_search_vector_update() RETURNS trigger AS $$
+                BEGIN
+                    NEW.search_vector := to_tsvector(COALESCE(NEW.body, ''));
+                    RETURN NEW;
+                END
+                $$ LANGUAGE plpgsql;
+
+                CREATE TRIGGER posts_post_search_vector_update
+                    BEFORE INSERT OR UPDATE OF body ON posts_post
+                    FOR EACH ROW EXECUTE PROCEDURE posts_post_search_vector_update();
+            """,
+            reverse_sql="""
+                DROP TRIGGER posts_post_search_vector_update ON posts_post;
+                DROP FUNCTION posts_post_search_vector_update();
+            """,
+        ),
+    ]
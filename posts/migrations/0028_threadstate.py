@@ -0,0 +1,31 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0027_post_search_vector_gin'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThreadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('platform', models.CharField(max_length=12)),
+                ('board', models.CharField(max_length=60)),
+                ('thread_id', models.IntegerField()),
+                ('etag', models.CharField(blank=True, max_length=200, null=True)),
+                ('last_modified_header', models.CharField(blank=True, max_length=40, null=True)),
+                ('last_post_id', models.IntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_modified', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='threadstate',
+            constraint=models.UniqueConstraint(fields=('platform', 'board', 'thread_id'), name='unique_thread_state'),
+        ),
+    ]
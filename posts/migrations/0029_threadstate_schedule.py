@@ -0,0 +1,47 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0028_threadstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='threadstate',
+            name='last_post_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadstate',
+            name='next_visit_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadstate',
+            name='post_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='threadstate',
+            name='post_rate',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='threadstate',
+            name='status',
+            field=models.CharField(choices=[('ACT', 'Active'), ('SLW', 'Slowing'), ('BMP', 'Bump Locked'), ('ARC', 'Archived'), ('DED', 'Dead')], default='ACT', max_length=3),
+        ),
+        migrations.AddField(
+            model_name='threadstate',
+            name='visited_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='threadstate',
+            index=models.Index(condition=models.Q(('next_visit_at__isnull', False)), fields=['next_visit_at'], name='thread_state_next_visit'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:42
+
+from django.db import migrations, models
+
+
+def set_archive_is_source(apps, schema_editor):
+    ScrapeJob = apps.get_model('posts', 'ScrapeJob')
+    ScrapeJob.objects.filter(url__contains='archive.').update(source='AIS')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0029_threadstate_schedule'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scrapejob',
+            name='in_progress',
+        ),
+        migrations.AddField(
+            model_name='scrapejob',
+            name='leased_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='scrapejob',
+            name='source',
+            field=models.CharField(choices=[('8KN', 'Eightkun'), ('AIS', 'Archive Is')], default='8KN', max_length=3),
+        ),
+        migrations.RunPython(set_archive_is_source, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='scrapejob',
+            index=models.Index(condition=models.Q(('error_count__lt', 2)), fields=['source', '-bounty'], name='scrape_job_claimable'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-18 08:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0030_scrapejob_queue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostLink',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target_platform', models.CharField(blank=True, max_length=12, null=True)),
+                ('target_board', models.CharField(max_length=60)),
+                ('target_thread_id', models.IntegerField()),
+                ('target_post_id', models.IntegerField(blank=True, null=True)),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='outgoing_links', to='posts.post')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='postlink',
+            index=models.Index(fields=['target_board', 'target_thread_id'], name='post_link_target_thread'),
+        ),
+    ]
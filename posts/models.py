@@ -1,8 +1,9 @@
 from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 
-from posts.choices import JobType
+from posts.choices import IngestStatus, JobSource, JobType, ThreadStatus
 
 
 class ScrapeJob(models.Model):
@@ -12,7 +13,8 @@ class ScrapeJob(models.Model):
     url = models.CharField(max_length=120)
     bounty = models.PositiveIntegerField(default=0)
     error_count = models.PositiveSmallIntegerField(default=0)
-    in_progress = models.BooleanField(default=False)
+    # Set while a spider has the job; a job whose lease has run out (say its spider died) can be claimed again
+    leased_until = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
 
@@ -21,12 +23,22 @@ class ScrapeJob(models.Model):
         choices=JobType.choices,
         default=JobType.NEW,
     )
+    source = models.CharField(  # Which spider scrapes the job
+        max_length=3,
+        choices=JobSource.choices,
+        default=JobSource.EIGHTKUN,
+    )
 
     class Meta:
         ordering = ['-bounty']
         constraints = [
             models.UniqueConstraint(fields=['platform', 'board', 'thread_id'], name='unique_thread')
         ]
+        indexes = [
+            # Jobs that can still be claimed, in the order they're claimed in
+            models.Index(fields=['source', '-bounty'], name='scrape_job_claimable',
+                         condition=models.Q(error_count__lt=2)),
+        ]
 
     def __str__(self):
         out = f'Bounty {self.bounty}: {self.url}'
@@ -35,11 +47,49 @@ class ScrapeJob(models.Model):
 
         if self.error_count > 0:
             out += f' Errors: {self.error_count}'
-        if self.in_progress:
-            out += ' IN PROGRESS'
+        if self.leased_until is not None:
+            out += f' LEASED UNTIL {self.leased_until}'
         return out
 
 
+class ThreadState(models.Model):
+    """
+    What was seen on the last visit to a live thread, so revisits only fetch and parse what changed since, and how fast
+    it's growing, which decides when it's visited next.
+    """
+    platform = models.CharField(max_length=12)
+    board = models.CharField(max_length=60)
+    thread_id = models.IntegerField()
+    etag = models.CharField(max_length=200, null=True, blank=True)  # ETag response header
+    last_modified_header = models.CharField(max_length=40, null=True, blank=True)  # Last-Modified response header
+    last_post_id = models.IntegerField(null=True, blank=True)  # Newest post archived from the thread
+    post_count = models.PositiveIntegerField(default=0)  # Posts archived from the thread
+    last_post_at = models.DateTimeField(null=True, blank=True)  # When the thread last got a new post
+    post_rate = models.FloatField(null=True, blank=True)  # Smoothed new posts per hour
+    status = models.CharField(
+        max_length=3,
+        choices=ThreadStatus.choices,
+        default=ThreadStatus.ACTIVE,
+    )
+    visited_at = models.DateTimeField(null=True, blank=True)
+    next_visit_at = models.DateTimeField(null=True, blank=True)  # None once the thread is archived or dead
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['platform', 'board', 'thread_id'], name='unique_thread_state')
+        ]
+        indexes = [
+            models.Index(fields=['next_visit_at'], name='thread_state_next_visit',
+                         condition=models.Q(next_visit_at__isnull=False)),
+        ]
+
+    def __str__(self):
+        return f'{self.platform}/{self.board}/{self.thread_id} ({self.get_status_display()}, last post ' \
+               f'{self.last_post_id})'
+
+
 class Platform(models.Model):
     name = models.CharField(max_length=12, unique=True)
 
@@ -111,27 +161,38 @@ class Post(models.Model):
         return f'https://8kun.top/{self.board.name}/res/{self.thread_id}.html#{self.post_id}'
 
     def process_links(self):
-        import re
-        matched_links = dict()
-        links = re.findall(r'>>([0-9]+)', self.body)
-        for link in links:
-            # Did we already match this link?
-            if link in matched_links:
-                continue
-            # Have we archived this post?
-            try:
-                linked_post = Post.objects.get(platform=self.platform, board=self.board, post_id=link)
-            except Exception:
-                linked_post = None
-            if linked_post is not None:
-                matched_links[f'>>{link}'] = linked_post.get_post_url()
-        self.links = matched_links
+        from posts.utilities import resolve_post_links, save_post_links
+        resolve_post_links([self])
         self.save()
+        save_post_links([(self.id, self.links)])
 
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['platform', 'board', 'post_id'], name='unique_post'),
         ]
+        indexes = [
+            GinIndex(fields=['search_vector'], name='post_search_vector_gin'),
+        ]
+
+
+class PostLink(models.Model):
+    """
+    A link in a post's `links` to a thread or a post in one. The links are rendered from the JSON, and kept here too
+    so that their targets can be aggregated in SQL.
+    """
+    post = models.ForeignKey('Post', on_delete=models.CASCADE, related_name='outgoing_links')
+    target_platform = models.CharField(max_length=12, null=True, blank=True)  # Only set in links to 4chan
+    target_board = models.CharField(max_length=60)
+    target_thread_id = models.IntegerField()
+    target_post_id = models.IntegerField(null=True, blank=True)  # None in links to a whole thread
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['target_board', 'target_thread_id'], name='post_link_target_thread'),
+        ]
+
+    def __str__(self):
+        return f'{self.post_id} -> {self.target_board}/{self.target_thread_id}#{self.target_post_id}'
 
 
 class RedditPost(models.Model):
@@ -196,3 +257,26 @@ class TextboardPost(models.Model):
 
     def get_post_url(self):
         return self.get_thread_url() + f'#{self.post_id}'
+
+
+class IngestManifest(models.Model):
+    """Progress of a data file through one of the load_*_data commands, so reruns can skip or resume it."""
+    path = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    content_hash = models.CharField(max_length=64)  # SHA-256
+    status = models.CharField(
+        max_length=2,
+        choices=IngestStatus.choices,
+        default=IngestStatus.IN_PROGRESS,
+    )
+    rows_committed = models.PositiveIntegerField(default=0)  # Rows of the file committed so far, from the start
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['path', 'size', 'content_hash'], name='unique_ingest_file')
+        ]
+
+    def __str__(self):
+        return f'{self.path} ({self.status}, {self.rows_committed} rows committed)'
@@ -1,39 +1,41 @@
-import re
 from datetime import datetime, timedelta
 
 import pandas as pd
 from celery import shared_task
+from django.conf import settings
+from django.db.models import Count, Exists, OuterRef
+from django.utils import timezone
 from scrapyd_api import ScrapydAPI
 
-from posts.choices import JobType
+from posts.choices import JobSource, JobType
 from posts.documents import PostDocument
-from posts.models import Post, ScrapeJob
-from posts.utilities import process_replies
+from posts.models import Post, PostLink, ScrapeJob, ThreadState
+from posts.utilities import claim_scrape_jobs, process_replies, save_thread_states, thread_states, \
+    upsert_scrape_jobs
 
 scrapyd = ScrapydAPI('http://localhost:6800')
 
 
 @shared_task
 def scrape_posts():
-    try:
-        # Grab top 30 8kun scrape jobs by bounty
-        eightkun_jobs = ScrapeJob.objects.filter(platform='8kun', error_count__lt=2, in_progress=False) \
-                            .order_by('-bounty')[:25]
-
-        # Grab top 30 archive.is jobs by bounty
-        archive_is_jobs = ScrapeJob.objects.filter(url__contains='archive.', error_count__lt=2, in_progress=False) \
-                              .order_by('-bounty')[:5]
-
-        # Create scrapyd task to scrape the 8kun posts
-        task = scrapyd.schedule('scrapy_project', '8kun_spider', jobs=','
-                                .join([f'{pk}' for pk in eightkun_jobs.values_list('pk', flat=True)]))
-
-        # Create scrapyd task to scrape the archive.is posts
-        task = scrapyd.schedule('scrapy_project', 'archive_is_spider', jobs=','
-                                .join([f'{pk}' for pk in archive_is_jobs.values_list('pk', flat=True)]))
+    lease = timedelta(seconds=settings.SCRAPE_JOB_LEASE_SECONDS)
+    spiders = [
+        ('8kun_spider', JobSource.EIGHTKUN, settings.SCRAPE_8KUN_BATCH_SIZE),
+        ('archive_is_spider', JobSource.ARCHIVE_IS, settings.SCRAPE_ARCHIVE_IS_BATCH_SIZE),
+    ]
+    for spider, source, batch_size in spiders:
+        job_ids, leased_until = [], None
+        try:
+            # Claim the top jobs by bounty and create a scrapyd task to scrape them under the claim
+            job_ids, leased_until = claim_scrape_jobs(source, batch_size, lease)
+            if job_ids:
+                task = scrapyd.schedule('scrapy_project', spider, jobs=','.join([f'{pk}' for pk in job_ids]),
+                                        lease=leased_until.isoformat())
 
-    except Exception as e:
-        print(e)
+        except Exception as e:
+            print(e)
+            # Nothing is scraping them, so let them be claimed again
+            ScrapeJob.objects.filter(id__in=job_ids, leased_until=leased_until).update(leased_until=None)
 
 
 @shared_task
@@ -51,170 +53,72 @@ def create_scrape_jobs():
         # Either no Posts or no ScrapeJobs, which is fine, let's move on
         pass
 
-    existing_threads = pd.DataFrame(
-        Post.objects.all()
-            .filter(is_op=True)
-            .values_list('platform__name', 'board__name', 'thread_id')
-            .distinct(), columns=['platform', 'board', 'thread_id'])
-
-    def to_local_url(row_):
-        if row_.platform == '8chan' or row_.platform == '8kun':
-            # Ignore platform; treat 8chan/8kun as single platform
-            return f'/{row_.board}/res/{row_.thread_id}.html'
-        return f'/{row_.platform}/{row_.board}/res/{row_.thread_id}.html'
-
-    # Query all posts in the database and construct their thread URLs
-    existing_threads['url'] = existing_threads.apply(to_local_url, axis=1)
-    existing_threads_set = set(existing_threads.url.unique())
-
-    # existing_threads now looks like this:
-    #   platform    board   thread_id   url
-    #   4chan       pol     146981635   /4chan/pol/res/146981635.html
-    #   ...         ...     ...         ...
-
-    total_posts = Post.objects.count()
-    num_batches = 8
-    batch_size = total_posts // num_batches
-    unarchived_threads = []
-
     interesting_boards = [
         'cbts', 'greatawakening', 'patriotsfight', 'pol', 'projectdcomms', 'qresearch', 'thestorm',
         'comms', 'doughlist', 'midnightriders', 'qrb', 'warroom'
     ]
 
-    for i in range(num_batches):
-        # Aggregate links from all threads
-        all_links = Post.objects.filter(board__name__in=interesting_boards) \
-                        .values_list('links', flat=True)[i * batch_size: i * batch_size + batch_size]
-        all_links = [list(links.values()) for links in all_links]
-        all_threads = []
-        for links in all_links:
-            all_threads.extend(links)
-
-        def get_thread_url(url):
-            return url.split('#')[0]
-
-        # We're going to check if we need to scrape this thread, so if it comes from 8chan/8kun,
-        # we'll check if we've already scraped it from the other site.
-        def process_if_8kun(thread):
-            if thread.startswith('/8chan') or thread.startswith('/8kun'):
-                without_first_slash = thread[1:]
-                slash_index = without_first_slash.find('/')
-                return without_first_slash[slash_index:]
-            return thread
-
-        # Find every thread link that isn't already in the database
-        all_threads = pd.Series(all_threads).to_frame('url')
-        all_threads['url'] = all_threads.url.apply(get_thread_url)  # Strip off the hash part of the URLs
-        all_threads['processed'] = all_threads.url.apply(process_if_8kun)
-        unarchived = all_threads[~all_threads.processed.isin(existing_threads_set)]
-        unarchived_threads.extend(unarchived.url)
-
-    # Find the link count of each unarchived thread; this becomes its "bounty"
-    urls = pd.Series(unarchived_threads).value_counts().rename_axis('url').reset_index(name='bounty')
-    urls = urls.dropna()
-    print('URLs to scrape:')
-    print(urls)
-
-    #                                      url  bounty
-    # 0              /8chan/comms/res/283.html   42081
-    # 1              /8chan/comms/res/220.html    1422
-    # 2         /8chan/qresearch/res/4352.html    1418
-    # 3       /8chan/patriotsfight/res/62.html    1323
-
-    # Now change the local URL to an actual scrapeable archive URL and parse out platform, board, and thread number
-    pattern = re.compile(r'/([a-z]+)/res/([0-9]+)')
-
-    def parse_url_to_archive_url(row_):
-        try:
-            match = re.match(pattern, row_['url']).groups()
-            board = match[0]
-            platform = '8kun'
-            thread_id = match[1]
-            sites = {'8chan': 'https://archive.today/newest/https://8ch.net', '8kun': 'https://8kun.top'}
-            final_url = f'{sites[platform]}/{board}/res/{thread_id}.html'
-            return platform, board, thread_id, final_url, row_['bounty']
-
-        except Exception as e:
-            print('Failed on row:')
-            print(row_)
-            print(e)
-
-    try:
-        urls = urls.apply(parse_url_to_archive_url, axis=1)
-        urls = urls.dropna().reset_index(drop=True)
-        archive_info = pd.DataFrame.from_records(urls, columns=['platform', 'board', 'thread_id', 'url', 'bounty'])
-
-        archive_info = archive_info.dropna()
-
-    except Exception as e:
-        print('Exception creating dataframe. Data:')
-        print(urls)
-        print(e)
-        raise e
+    # Count the links from interesting boards to each 8chan/8kun thread that isn't archived; this becomes its
+    # "bounty". A thread is archived if its OP is, and an OP's post ID is its thread ID, so the unique post index
+    # answers that.
+    archived = Post.objects.filter(platform__name__in=['8chan', '8kun'], board__name=OuterRef('target_board'),
+                                   post_id=OuterRef('target_thread_id'), is_op=True)
+    unarchived = PostLink.objects.filter(post__board__name__in=interesting_boards, target_platform__isnull=True) \
+        .filter(~Exists(archived)) \
+        .values('target_board', 'target_thread_id') \
+        .annotate(bounty=Count('id')) \
+        .order_by('-bounty')
+    archive_info = pd.DataFrame.from_records(unarchived.values_list('target_board', 'target_thread_id', 'bounty'),
+                                             columns=['board', 'thread_id', 'bounty'])
+    archive_info['platform'] = '8kun'
+    archive_info['url'] = 'https://8kun.top/' + archive_info.board + '/res/' + archive_info.thread_id.astype(str) + \
+                          '.html'
+    print('Threads to scrape:')
+    print(archive_info)
+
+    #            board  thread_id  bounty platform                                      url
+    # 0          comms        283   42081     8kun          https://8kun.top/comms/res/283.html
+    # 1          comms        220    1422     8kun          https://8kun.top/comms/res/220.html
+    # 2      qresearch       4352    1418     8kun      https://8kun.top/qresearch/res/4352.html
 
     # Create scrape jobs for these unarchived URLs if not existing; else update bounty
-    new_jobs = 0
-    for index, row in archive_info.iterrows():
-        try:
-            obj, created = ScrapeJob.objects.update_or_create(platform=row['platform'], board=row['board'],
-                                                              thread_id=row['thread_id'],
-                                                              defaults={
-                                                                  'bounty': row['bounty'],
-                                                                  'url': row['url'],
-                                                              })
-            if created:
-                new_jobs += 1
-
-        except Exception as e:
-            print(e)
-
-    print(f'Created {new_jobs} new jobs.')
+    archive_info['job_type'] = JobType.NEW
+    archive_info['source'] = JobSource.EIGHTKUN
+    created, updated = upsert_scrape_jobs(archive_info)
+    print(f'Created {created} new jobs, updated {updated}.')
 
 
 @shared_task
-def revisit_recent_threads(days=14):
-    now = datetime.now()
-    two_weeks_ago = now - timedelta(days=days)
-    s = PostDocument().search()
-    needs_revisited = pd.DataFrame(s.query('range', timestamp={'gte': two_weeks_ago})
-                                   .query('match', is_op=True)
-                                   .extra(size=10000)
-                                   .to_queryset()
-                                   .values_list('board__name', 'thread_id'), columns=['board', 'thread_id'])
-
-    def get_scrape_url(_row):
-        return f'https://8kun.top/{_row.board}/res/{_row.thread_id}.html'
-
-    def check_if_full(_row):
-        archived_posts_count = s.query('match', board__name=_row.board) \
-            .query('match', thread_id=_row.thread_id).count()
-        if archived_posts_count >= 752:
-            return True
-        return False
-
-    needs_revisited['full'] = needs_revisited.apply(check_if_full, axis=1)
-    needs_revisited['url'] = needs_revisited.apply(get_scrape_url, axis=1)
-
-    new_jobs = 0
-    for index, row in needs_revisited.iterrows():
-        if row['full']:
-            continue
-        try:
-            obj, created = ScrapeJob.objects.update_or_create(url=row['url'], defaults={
-                'bounty': 10,
-                'platform': '8kun',
-                'board': row['board'],
-                'thread_id': row['thread_id'],
-                'job_type': JobType.REVISIT
-            })
-            if created:
-                new_jobs += 1
-
-        except Exception as e:
-            print(e)
-
-    print(f'Created {new_jobs} new jobs.')
+def schedule_revisits(days=14):
+    """
+    Queue revisits of the 8kun threads that are due one. Each visit schedules the thread's next by how fast it's
+    growing, so fast threads are revisited every few minutes and dead or archived ones never again.
+    """
+    now = timezone.now()
+
+    # Start tracking recent threads that were archived some other way than by a visit
+    untracked = Post.objects.filter(platform__name='8kun', is_op=True, timestamp__gte=now - timedelta(days=days)) \
+        .filter(~Exists(ThreadState.objects.filter(platform='8kun', board=OuterRef('board__name'),
+                                                   thread_id=OuterRef('thread_id')))) \
+        .values_list('board__name', 'thread_id')
+    new_states = list(thread_states('8kun', list(untracked)).values())
+    for state in new_states:
+        state.next_visit_at = now
+    save_thread_states(new_states)
+    print(f'Tracking {len(new_states)} new threads.')
+
+    due = pd.DataFrame(ThreadState.objects.filter(platform='8kun', next_visit_at__lte=now)
+                       .values_list('board', 'thread_id', 'post_rate', 'visited_at'),
+                       columns=['board', 'thread_id', 'post_rate', 'visited_at'])
+    # Threads expected to have more new posts are worth more
+    hours = (pd.Timestamp(now) - pd.to_datetime(due.visited_at, utc=True)).dt.total_seconds().fillna(0) / 3600
+    due['bounty'] = (10 + (due.post_rate.fillna(0) * hours).round()).astype(int)
+    due['platform'] = '8kun'
+    due['url'] = 'https://8kun.top/' + due.board + '/res/' + due.thread_id.astype(str) + '.html'
+    due['job_type'] = JobType.REVISIT
+    due['source'] = JobSource.EIGHTKUN
+    created, updated = upsert_scrape_jobs(due, update_fields=['bounty', 'url', 'job_type', 'source'])
+    print(f'Created {created} new jobs, updated {updated}.')
 
 
 @shared_task
@@ -1,3 +1,673 @@
-from django.test import TestCase
+import contextlib
+import glob
+import html
+import http.server
+import importlib
+import io
+import os
+import random
+import tempfile
+import threading
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.test import SimpleTestCase
+from scrapy import signals
+from scrapy.crawler import CrawlerRunner
+from scrapy.http import HtmlResponse
+from tqdm import tqdm
+from twisted.internet import defer, reactor
+
+from posts.choices import JobType, ThreadStatus
+from posts.management.commands.find_textboard_socks import SHARED_POSTER_HASHES, find_socks
+from posts.management.commands.load_chan_data import catalog_archived_posts, parse_chan_task, read_chan_files
+from posts.management.commands.load_reddit_data import BOOL_COLUMNS, prepare_reddit_frame
+from posts.models import ScrapeJob, ThreadState
+
+from posts.utilities import parse_archive_is, parse_archive_is_headers, process_links, process_links_from_df, \
+    process_replies_from_df, parse_formatting, parse_8chan_formatting, lxml_parse_formatting, \
+    lxml_parse_8chan_formatting, archived_mask, record_thread_visit, pipelined_map, read_csv_thread_chunks
+
+
+def legacy_process_replies_from_df(df):
+    """process_replies_from_df as it was before it was vectorized, kept as the reference implementation."""
+    all_replies = {}
+    df_with_replies = pd.DataFrame()
+
+    def aggregate_replies(row):
+        def get_post_url(row_):
+            if row_['platform'] == '4chan':
+                return f"/{row_['platform']}/{row_['board']}/res/{row_['thread_no']}.html" + '#' + str(
+                    int(row_['post_no']))
+            else:
+                return f"/{row_['board']}/res/{row_['thread_no']}.html" + '#' + str(int(row_['post_no']))
+
+        try:
+            for link, url in dict(row['links']).items():
+                try:
+                    if row['platform'] == '4chan':
+                        _, platform, board, _, end = url.split('/')
+                    else:
+                        _, board, _, end = url.split('/')
+                    if '#' in end:
+                        post_no = int(end.split('.')[-1].split('#')[-1])
+                    else:
+                        post_no = int(end.split('.')[0])
+
+                    if post_no in all_replies:
+                        all_replies[post_no].append([str(int(row['post_no'])), get_post_url(row)])
+                    else:
+                        all_replies[post_no] = [[str(int(row['post_no'])), get_post_url(row)]]
+                except Exception as e:
+                    print(e)
+                continue
+        except Exception as e:
+            print(type(row['links']))
+            print(row['links'])
+            print(e)
+
+    def link_replies(row):
+        try:
+            if int(float(
+                    row['post_no'])) in all_replies:  # Looks hacky but we have to do this to handle e.g. '8222326.0'
+                row['replies'] = sorted(all_replies[int(row['post_no'])], key=lambda x: x[0])
+            else:
+                row['replies'] = dict()
+            return row
+        except Exception as e:
+            print('Exception linking replies on row:')
+            print(row)
+            print(e)
+            return row
+
+    threads = df.thread_no.unique()
+    for thread in threads:
+        all_replies = {}
+        thread_df = df[df.thread_no == thread].copy().reset_index()
+        if len(thread_df) == 0:
+            continue
+        thread_df.apply(aggregate_replies, axis=1)
+        df_with_replies = pd.concat([df_with_replies, thread_df.apply(link_replies, axis=1)])
+    return df_with_replies.reset_index(drop=True)
+
+
+def load_8chan_threads():
+    """The bundled data/8chan threads, parsed up to the point where load_chan_data processes replies."""
+    threads = []
+    for file in sorted(glob.glob('data/8chan/*.csv')):
+        df = pd.read_csv(file)
+        if df['board'].iloc[0] != 'qresearch':
+            df, failures = parse_archive_is_headers(df)
+        df['post_no'] = df['post_no'].astype(str)
+        df['thread_no'] = df['thread_no'].astype(str)
+        df['platform'] = '8chan'
+        df['links'] = df.apply(process_links, axis=1)
+        threads.append(df.reset_index())
+    return threads
+
+
+class ProcessRepliesFromDfTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.threads = load_8chan_threads()
+
+    def assertSameReplies(self, df):
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = legacy_process_replies_from_df(df.copy())
+        actual = process_replies_from_df(df.copy())
+        self.assertEqual(list(actual.columns), list(expected.columns))
+        self.assertEqual(list(actual.dtypes), list(expected.dtypes))
+        self.assertEqual(actual.to_csv(), expected.to_csv())
+
+    def test_fixtures_exist(self):
+        self.assertGreater(len(self.threads), 0)
+
+    def test_matches_legacy_per_thread(self):
+        for df in self.threads:
+            with self.subTest(thread=df.thread_no.iloc[0]):
+                self.assertSameReplies(df)
+
+    def test_matches_legacy_across_threads(self):
+        self.assertSameReplies(pd.concat(self.threads).reset_index(drop=True))
+
+
+class ThreadChunksTest(SimpleTestCase):
+    # Thread 2 alone is longer than the chunk size
+    thread_sizes = [3, 12, 2, 5, 1, 4]
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.file = os.path.join(directory.name, 'threads.csv')
+        thread_nos = [thread_no for thread_no, size in enumerate(self.thread_sizes, 1) for _ in range(size)]
+        pd.DataFrame({'thread_no': thread_nos, 'post_no': range(len(thread_nos))}).to_csv(self.file, index=False)
+
+    def test_threads_never_span_chunks(self):
+        chunks = list(read_csv_thread_chunks(self.file, 'thread_no', 4))
+        self.assertEqual(pd.concat(chunks).post_no.tolist(), list(range(sum(self.thread_sizes))))
+        seen = set()
+        for chunk in chunks:
+            threads = set(chunk.thread_no)
+            self.assertFalse(threads & seen)
+            seen |= threads
+        self.assertIn([2] * 12, [chunk.thread_no.tolist() for chunk in chunks])
+
+    def test_resume_skips_committed_rows(self):
+        for rows_committed in [0, 2, 3, 15, 20, 27]:
+            manifest = SimpleNamespace(rows_committed=rows_committed)
+            with self.subTest(rows_committed=rows_committed), \
+                    mock.patch('posts.utilities.ingest_manifest', return_value=manifest), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                tasks = list(read_chan_files([self.file], '8kun', chunksize=4))
+            frames = [df for df, *_ in tasks if df is not None]
+            post_nos = pd.concat(frames).post_no.tolist() if frames else []
+            self.assertEqual(post_nos, list(range(rows_committed, sum(self.thread_sizes))))
+            self.assertEqual(tasks[-1][1:], ('8kun', manifest, sum(self.thread_sizes), True))
+            self.assertIsNone(tasks[-1][0])
+
+
+class PipelinedMapTest(SimpleTestCase):
+    def parse_files(self, workers):
+        tasks = [(pd.read_csv(file), '8chan', None, 0, True) for file in sorted(glob.glob('data/8chan/*.csv'))]
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            return list(pipelined_map(parse_chan_task, tasks, workers=workers, initializer=catalog_archived_posts,
+                                      initargs=({},)))
+
+    def test_workers_match_serial_parse(self):
+        tqdm.pandas()
+        serial = self.parse_files(1)
+        parallel = self.parse_files(2)
+        self.assertGreater(len(serial), 1)
+        self.assertEqual([df.thread_no.iloc[0] for *_, df in parallel], [df.thread_no.iloc[0] for *_, df in serial])
+        for (*_, expected), (*_, actual) in zip(serial, parallel):
+            self.assertEqual(actual.to_csv(), expected.to_csv())
+
+
+class ParseArchiveIsHeadersTest(SimpleTestCase):
+    def test_matches_parse_archive_is_on_fixtures(self):
+        for file in sorted(glob.glob('data/8chan/*.csv')):
+            df = pd.read_csv(file)
+            if df['board'].iloc[0] == 'qresearch':
+                continue
+            with self.subTest(file=file):
+                parsed, failures = parse_archive_is_headers(df, batch_size=100)
+                self.assertEqual(failures, {})
+                self.assertEqual(parsed.to_csv(), pd.DataFrame(list(df.apply(parse_archive_is, axis=1))).to_csv())
+
+    def test_counts_failures_instead_of_raising(self):
+        df = pd.read_csv(sorted(glob.glob('data/8chan/*.csv'))[0]).head(3)
+        df.loc[1, 'header'] = '<span>No name or post number here</span>'
+        df.loc[2, 'header'] = None
+        parsed, failures = parse_archive_is_headers(df)
+        self.assertEqual(len(parsed), 1)
+        self.assertEqual(failures, {'missing name': 2})
+
+
+class ProcessLinksFromDfTest(SimpleTestCase):
+    def assertSameLinks(self, df):
+        expected = df.apply(process_links, axis=1)
+        actual, records = process_links_from_df(df)
+        self.assertEqual(list(actual.index), list(expected.index))
+        for actual_links, expected_links in zip(actual, expected):
+            self.assertEqual(list(actual_links.items()), list(expected_links.items()))
+
+    def test_matches_process_links_on_fixtures(self):
+        frames = []
+        for file in sorted(glob.glob('data/8chan/*.csv')):
+            df = pd.read_csv(file).rename(columns={'body': 'body_text'})
+            df['platform'] = '8chan'
+            frames.append(df)
+        self.assertSameLinks(pd.concat(frames))
+
+    def test_matches_process_links_on_8kun_markup(self):
+        df = pd.DataFrame({
+            'platform': ['8kun', '8kun', '8kun', '4chan', '8kun'],
+            'body_text': [
+                '<a onclick="highlightReply(\'12\', event);" href="/qresearch/res/10.html#12">&gt;&gt;12</a>'
+                '<a href="/qresearch/res/10.html#12">&gt;&gt;12</a><a href="/pol/index.html">&gt;&gt;&gt;/pol/</a>',
+                '<a href="/qresearch/res/10.html#q11">&gt;&gt;&gt;/qresearch/11</a>',
+                'no links here',
+                '<a href="/pol/res/1.html#2">&gt;&gt;2</a>',
+                None,
+            ],
+        }, index=[5, 3, 1, 0, 2])
+        self.assertSameLinks(df)
+        links, records = process_links_from_df(df)
+        self.assertEqual(links[5], {'>>12': '/qresearch/res/10.html#12', '>>>/pol/': '/8kun/pol/'})
+        self.assertEqual(list(records.kind), ['post', 'post', 'board', 'post', 'post'])
+        self.assertEqual(list(records.row), [0, 0, 0, 1, 3])
+
+
+INLINE_TAGS = ['strong', 'em', 'u', 's', 'span', 'a']
+INLINE_CLASSES = ['quote', 'heading', 'spoiler', 'detected', '']
+INLINE_TEXTS = ['hello', ' ', '  ', '\n', '//', '&gt;&gt;123', '&amp; more', 'café', 'a < b', 'x\ty', '']
+# Block elements that turn up inside lines, like 8kun's code blocks
+BLOCK_TAGS = ['pre', 'div', 'ul', 'blockquote', 'p']
+
+
+def random_block(rng, depth):
+    tag = rng.choice(BLOCK_TAGS)
+    attrs = ' class="code lang-"' if tag == 'pre' else ''
+    children = ''.join(random_inline(rng, depth + 1) for _ in range(rng.randint(0, 3)))
+    if tag == 'ul':
+        children = f'<li>{children}</li>'
+    return f'<{tag}{attrs}>{children}</{tag}>'
+
+
+def random_inline(rng, depth=0, in_link=False):
+    if depth > 3 or rng.random() < 0.35:
+        # Now and then a Windows line break
+        return rng.choice(INLINE_TEXTS) if rng.random() < 0.99 else 'a\r\nb'
+    if rng.random() < 0.02:
+        return random_block(rng, depth)
+    tag = rng.choice([tag for tag in INLINE_TAGS if not (in_link and tag == 'a')])  # Anchors can't nest in HTML
+    cls = rng.choice(INLINE_CLASSES)
+    attrs = f' class="{cls}"' if cls else ''
+    if tag == 'a':
+        attrs += ' href="/qresearch/res/1.html#2"'
+    children = ''.join(random_inline(rng, depth + 1, in_link or tag == 'a') for _ in range(rng.randint(0, 3)))
+    if tag == 'em' and rng.random() < 0.3:
+        children = '//'
+    return f'<{tag}{attrs}>{children}</{tag}>'
+
+
+def random_8kun_body(rng):
+    """A random 8kun-style post body, nesting every kind of formatting the converters handle."""
+    lines = []
+    for _ in range(rng.randint(0, 6)):
+        cls = rng.choice(['body-line ltr ', 'body-line ltr quote', 'body-line empty ', 'body-line ltr rquote'])
+        lines.append(f'<p class="{cls}">' + ''.join(random_inline(rng) for _ in range(rng.randint(0, 4))) + '</p>')
+        if rng.random() < 0.2:
+            lines.append('<br/>')
+    return '<div class="body">' + ''.join(lines) + '</div>'
+
+
+class LxmlFormattingTest(SimpleTestCase):
+    """Differential tests of the lxml converters against the BeautifulSoup functions they replace."""
+
+    def test_8chan_matches_bs4_on_fixtures(self):
+        for file in sorted(glob.glob('data/8chan/*.csv')):
+            for body in pd.read_csv(file).body.fillna(''):
+                self.assertEqual(lxml_parse_8chan_formatting(body), parse_8chan_formatting(body), body)
+
+    def test_8kun_matches_bs4_on_generated_markup(self):
+        rng = random.Random(0)
+        for _ in range(5000):
+            body = random_8kun_body(rng)
+            self.assertEqual(lxml_parse_formatting(body), parse_formatting(body), body)
+
+    def test_block_elements_keep_their_text(self):
+        body = '<p class="body-line ltr ">code: <pre class="code lang-">x = 1</pre> after</p>'
+        self.assertEqual(lxml_parse_formatting(body), 'code: x = 1 after')
+        self.assertEqual(lxml_parse_formatting('<p class="body-line">a<div>b</div>c</p>'), 'abc')
+        self.assertEqual(lxml_parse_8chan_formatting('<div>a<p>b<ul><li>c</li></ul></p>d</div>'), 'abcd')
+
+    def test_carriage_returns_are_kept(self):
+        self.assertEqual(lxml_parse_formatting('<p class="body-line ltr ">a\r\nb</p>'), 'a\r\nb')
+
+    def test_url_slashes_are_not_italicized(self):
+        body = '<p class="body-line ltr ">https:<em>//</em>8kun.top <em>really</em></p>'
+        self.assertEqual(lxml_parse_formatting(body), "https://8kun.top ''really''")
+
+    def test_empty_body(self):
+        self.assertEqual(lxml_parse_formatting(''), '')
+        self.assertEqual(lxml_parse_8chan_formatting(''), '')
+
+
+class ArchivedMaskTest(SimpleTestCase):
+
+    def test_matches_board_and_post_number(self):
+        catalog = {'qresearch': np.array([3, 7, 12], dtype=np.int64), 'pol': np.array([], dtype=np.int64)}
+        boards = ['qresearch', 'qresearch', 'qresearch', 'pol', 'comms', 'qresearch', 'qresearch']
+        post_nos = ['7', '8', '12.0', '7', '3', '', '99']
+        self.assertEqual(archived_mask(catalog, boards, post_nos).tolist(),
+                         [True, False, True, False, False, False, False])
+
+
+def legacy_read_reddit_csv(file):
+    """How load_reddit_data read a Reddit CSV before it was vectorized."""
+    def convert_bool(val):
+        if not val:
+            return False
+        return val == 'TRUE'
+
+    def convert_int(val):
+        if not val:
+            return 0
+        if isinstance(val, str):
+            return int(float(val))
+        return val
+
+    return pd.read_csv(file, converters={'num_comments': convert_int, 'is_submitter': convert_bool,
+                                         'is_self': convert_bool, 'locked': convert_bool, 'over_18': convert_bool,
+                                         'stickied': convert_bool, 'no_follow': convert_bool})
+
+
+def legacy_prepare_reddit_frame(df):
+    """prepare_reddit_frame as it was before it was vectorized, kept as the reference implementation."""
+    def process_link_id_and_parent(row):
+        row['thread_hash'] = row['permalink'].split('/')[6]
+        row['thread_slug'] = row['permalink'].split('/')[7]
+        if row['item_type'] == 'comment':
+            row['link_id'] = row['permalink'].split('/')[-2]
+            row['parent_id'] = row['parent_id'].split('_')[-1]
+        else:
+            row['link_id'] = row['thread_hash']
+            row['parent_id'] = None
+        return row
+
+    df = df.replace('None', None)
+    if 'edited' not in df:
+        df['edited'] = None
+    df['subreddit'] = df.loc[0].subreddit
+    df['is_op'] = df['item_type'] == 'submission'
+    df['edited'] = pd.to_datetime(df['edited'], unit='s')
+    df['created_utc'] = pd.to_datetime(df['created_utc'])
+    df['created_utc'] = df['created_utc'].dt.tz_localize(tz='UTC')
+    df['edited'] = df['edited'].dt.tz_localize(tz='UTC')
+    df['scraped_on'] = pd.to_datetime(df['scraped_on'])
+    df['scraped_on'] = df['scraped_on'].dt.tz_localize(tz='UTC')
+    df = df.apply(process_link_id_and_parent, axis=1)
+    df['edited'] = df['edited'].astype(object).where(df['edited'].notnull(), None)
+    df['text'] = df.text.fillna('')
+    df['text'] = df.text.astype(str)
+    df['title'] = df.title.astype(str)
+    df['text'] = df.text.apply(html.unescape)
+    df['title'] = df.title.apply(html.unescape)
+    df['created_utc'] = df['created_utc'].astype(object).where(df['created_utc'].notnull(), None)
+    df = df.dropna(subset=['score', 'author', 'text'])
+    return df
+
+
+def committed_values(values):
+    """The values of a column as commit_reddit_posts_from_df passes them on, with every kind of null as None."""
+    return [None if value is None or value is pd.NaT or value != value else value for value in values]
+
+
+class PrepareRedditFrameTest(SimpleTestCase):
+    # The columns commit_reddit_posts_from_df reads that prepare_reddit_frame is meant to leave as they were
+    unchanged_columns = ['subreddit', 'created_utc', 'edited', 'author_flair_text', 'scraped_on', 'permalink', 'score',
+                         'post_hint', 'author', 'text', 'url', 'is_op', 'thread_hash', 'thread_slug', 'num_comments',
+                         'link_id', 'parent_id']
+
+    def test_matches_legacy_on_sample_apart_from_fixes(self):
+        files = sorted(glob.glob('data/reddit/*.csv'))
+        self.assertGreater(len(files), 0)
+        for file in files:
+            raw = pd.read_csv(file, dtype=str)
+            expected = legacy_prepare_reddit_frame(legacy_read_reddit_csv(file))
+            actual = prepare_reddit_frame(raw.copy())
+            self.assertEqual(list(actual.index), list(expected.index))
+            for column in self.unchanged_columns:
+                with self.subTest(file=file, column=column):
+                    self.assertEqual(committed_values(actual[column]), committed_values(expected[column]))
+
+            # Booleans are read case-insensitively, where the legacy converters only took 'TRUE'
+            for column in BOOL_COLUMNS:
+                self.assertEqual(actual[column].tolist(), (raw[column].str.upper() == 'TRUE').tolist())
+                self.assertEqual(expected[column].tolist(), (raw[column] == 'TRUE').tolist())
+            self.assertTrue((raw.stickied == 'True').any())
+
+            # A missing title was the string 'None', and a missing author_fullname failed the NOT NULL constraint
+            missing = raw.title.isna() | (raw.title == 'None')
+            self.assertTrue(missing.any())
+            self.assertEqual(set(actual.title[missing]), {''})
+            self.assertEqual(set(expected.title[missing]), {'None'})
+            self.assertEqual(actual.title[~missing].tolist(), expected.title[~missing].tolist())
+            missing = raw.author_fullname.isna() | (raw.author_fullname == 'None')
+            self.assertEqual(set(actual.author_fullname[missing]), {''})
+            self.assertEqual(committed_values(expected.author_fullname[missing]), [None] * missing.sum())
+            self.assertEqual(actual.author_fullname[~missing].tolist(), expected.author_fullname[~missing].tolist())
+
+
+def legacy_find_socks(df):
+    """find_textboard_socks as it was before it grouped whole boards, on one DataFrame of posts, thread by thread."""
+    socks = pd.Series([[] for _ in range(len(df))], index=df.index, dtype=object)
+    for thread_id, posts in df.groupby('thread_id'):
+        hash_tripcodes_map = dict()
+        for poster_hash, tripcode in set(zip(posts.poster_hash, posts.tripcode)):
+            if tripcode is None:
+                continue
+            hash_tripcodes_map.setdefault(poster_hash, []).append(tripcode)
+        for index, post in posts.iterrows():
+            if not post.tripcode and post.poster_hash in hash_tripcodes_map and \
+                    post.poster_hash not in SHARED_POSTER_HASHES + [None]:
+                socks[index] = hash_tripcodes_map[post.poster_hash]
+    return socks
+
+
+def textboard_posts(rows):
+    return pd.DataFrame(rows, columns=['thread_id', 'poster_hash', 'tripcode'])
+
+
+class FindSocksTest(SimpleTestCase):
+    def test_poster_hash_shared_across_tripcodes(self):
+        df = textboard_posts([(1, 'abc', '!b'), (1, 'abc', '!a'), (1, 'abc', '!b'), (1, 'abc', None), (2, 'abc', None)])
+        # IDs are per thread, so the same ID in thread 2 is someone else
+        self.assertEqual(find_socks(df).tolist(), [[], [], [], ['!a', '!b'], []])
+
+    def test_same_thread_id_on_two_boards(self):
+        # Boards are scanned one at a time, so a thread ID on another board doesn't lend its tripcodes
+        board = textboard_posts([(1, 'abc', None), (1, 'def', '!d')])
+        other_board = textboard_posts([(1, 'abc', '!a'), (1, 'def', None)])
+        self.assertEqual(find_socks(board).tolist(), [[], []])
+        self.assertEqual(find_socks(other_board).tolist(), [[], []])
+        both = pd.concat([board, other_board], ignore_index=True)
+        self.assertEqual(sorted(map(sorted, legacy_find_socks(both))), [[], [], ['!a'], ['!d']])
+
+    def test_posts_without_tripcodes(self):
+        df = textboard_posts([(1, 'abc', None), (1, 'abc', ''), (1, None, None), (1, '???', None), (1, '???', '!q'),
+                              (1, 'def', '!d'), (1, None, '!n')])
+        # An empty tripcode is none at all, where the per-thread version made its poster a sock of ''
+        self.assertEqual(find_socks(df).tolist(), [[], [], [], [], [], [], []])
+        self.assertEqual(legacy_find_socks(df).tolist(), [[''], [''], [], [], [], [], []])
+
+    def test_tripcodes_are_in_a_stable_order(self):
+        rng = random.Random(0)
+        rows = [(rng.randint(1, 5), rng.choice(['a', 'b', 'c', '???', None]),
+                 rng.choice(['!x', '!y', '!z', None, None])) for _ in range(300)]
+        df = textboard_posts(rows)
+        socks = find_socks(df)
+        shuffled = df.sample(frac=1, random_state=1)
+        self.assertEqual(find_socks(shuffled).sort_index().tolist(), socks.tolist())
+        for tripcodes in socks:
+            self.assertEqual(tripcodes, sorted(tripcodes))
+        # The same tripcodes as the per-thread version, which listed them in set order
+        self.assertEqual(socks.tolist(), [sorted(tripcodes) for tripcodes in legacy_find_socks(df)])
+
+
+def eightkun_thread_page(post_nos):
+    posts = ''.join(f'<div class="post"><p class="intro"><span class="name">Anonymous</span>'
+                    f'<time datetime="2020-01-01T00:00:00Z"></time><a class="post_anchor"></a>'
+                    f'<a class="post_no">No.</a><a class="post_no">{post_no}</a></p>'
+                    f'<div class="body">Post {post_no}</div></div>' for post_no in post_nos)
+    return f'<html><body>{posts}</body></html>'.encode()
+
+
+class EightKunSpiderRevisitTest(SimpleTestCase):
+    url = 'https://8kun.top/qresearch/res/100.html'
+
+    def setUp(self):
+        spider_module = importlib.import_module('scrapy_project.scrapy_project.spiders.8kun_spider')
+        self.spider = spider_module.EightKunSpider()
+        self.spider.jobs = {1: ScrapeJob(id=1, platform='8kun', board='qresearch', thread_id=100, url=self.url,
+                                         job_type=JobType.REVISIT)}
+        self.spider.thread_states = {('qresearch', 100): ThreadState(platform='8kun', board='qresearch', thread_id=100,
+                                                                     etag='"abc"', last_post_id=102)}
+
+    def parse(self, status, body=b'', headers=None):
+        return list(self.spider.parse(HtmlResponse(self.url, status=status, body=body, headers=headers), job_id=1))
+
+    def test_conditional_request(self):
+        request = next(self.spider.start_requests())
+        self.assertEqual(request.headers.get('If-None-Match'), b'"abc"')
+        self.assertNotIn('If-Modified-Since', request.headers)
+
+    def test_not_modified_completes_thread_without_posts(self):
+        self.assertEqual(self.parse(304), [{'thread_complete': True, 'url': self.url}])
+
+    def test_not_found_completes_thread_as_gone(self):
+        self.assertEqual(self.parse(404), [{'thread_complete': True, 'url': self.url, 'gone': True}])
+
+    def test_parses_only_posts_after_last_archived(self):
+        items = self.parse(200, eightkun_thread_page([100, 101, 102, 103, 104]), {'ETag': '"def"'})
+        self.assertEqual([item['post_no'] for item in items[:-1]], ['103', '104'])
+        self.assertEqual(items[-1], {'thread_complete': True, 'url': self.url, 'etag': '"def"',
+                                     'last_modified_header': None, 'last_post_id': 104,
+                                     'last_post_at': datetime(2020, 1, 1, tzinfo=timezone.utc)})
+
+    def test_new_job_scrapes_whole_thread(self):
+        # Its later posts are archived, but its OP isn't
+        self.spider.jobs[1].job_type = JobType.NEW
+        request = next(self.spider.start_requests())
+        self.assertNotIn('If-None-Match', request.headers)
+        items = self.parse(200, eightkun_thread_page([100, 101, 102, 103]))
+        self.assertEqual([item['post_no'] for item in items[:-1]], ['100', '101', '102', '103'])
+        self.assertEqual(self.spider.thread_states[('qresearch', 100)].post_count, 0)
+
+    def test_unchanged_page_without_validators(self):
+        items = self.parse(200, eightkun_thread_page([100, 101, 102]))
+        self.assertEqual(items, [{'thread_complete': True, 'url': self.url, 'etag': None,
+                                  'last_modified_header': None, 'last_post_id': 102, 'last_post_at': None}])
+
+
+class FixtureThreadHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a thread page with an ETag and Last-Modified, answering 304 Not Modified to a matching If-None-Match"""
+    page = eightkun_thread_page([100, 101, 102])
+    etag = '"v1"'
+    last_modified = 'Wed, 01 Jan 2020 00:00:00 GMT'
+    # (If-None-Match, If-Modified-Since) of each request received
+    requests = []
+
+    def do_GET(self):
+        self.requests.append((self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(self.page)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', self.last_modified)
+        self.end_headers()
+        self.wfile.write(self.page)
+
+    def log_message(self, *args):
+        pass
+
+
+class EightKunSpiderCrawlTest(SimpleTestCase):
+    def setUp(self):
+        self.server = http.server.HTTPServer(('127.0.0.1', 0), FixtureThreadHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        FixtureThreadHandler.requests = []
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_revisit_sends_validators_and_gets_not_modified(self):
+        # The reactor can't be restarted, so both visits are crawled in this one test
+        url = f'http://127.0.0.1:{self.server.server_port}/qresearch/res/100.html'
+        job = ScrapeJob(id=1, platform='8kun', board='qresearch', thread_id=100, url=url, job_type=JobType.REVISIT)
+        state = ThreadState(platform='8kun', board='qresearch', thread_id=100)
+        spider_module = importlib.import_module('scrapy_project.scrapy_project.spiders.8kun_spider')
+
+        class FixtureSpider(spider_module.EightKunSpider):
+            name = 'fixture_8kun_spider'
+
+            def __init__(self, *args, **kwargs):
+                super(FixtureSpider, self).__init__(*args, **kwargs)
+                self.jobs = {job.id: job}
+                self.thread_states = {(job.board, job.thread_id): state}
+
+        runner = CrawlerRunner({'TELNETCONSOLE_ENABLED': False, 'LOG_ENABLED': False})
+        visits = [[], []]
+        errors = []
+
+        @defer.inlineCallbacks
+        def crawl():
+            try:
+                for items in visits:
+                    def item_scraped(item, **kwargs):
+                        items.append(item)
+                    crawler = runner.create_crawler(FixtureSpider)
+                    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+                    yield runner.crawl(crawler)
+                    # As the pipeline records the visit
+                    completion = items[-1] if items else {}
+                    state.etag = completion.get('etag') or state.etag
+                    state.last_modified_header = completion.get('last_modified_header') or state.last_modified_header
+                    state.last_post_id = completion.get('last_post_id') or state.last_post_id
+            except Exception as e:
+                errors.append(e)
+            finally:
+                reactor.stop()
+
+        reactor.callWhenRunning(crawl)
+        reactor.callLater(60, reactor.stop)
+        reactor.run(installSignalHandlers=False)
+
+        self.assertEqual(errors, [])
+        self.assertEqual(FixtureThreadHandler.requests, [(None, None), ('"v1"', 'Wed, 01 Jan 2020 00:00:00 GMT')])
+        self.assertEqual([item['post_no'] for item in visits[0][:-1]], ['100', '101', '102'])
+        self.assertEqual(visits[0][-1], {'thread_complete': True, 'url': url, 'etag': '"v1"',
+                                         'last_modified_header': 'Wed, 01 Jan 2020 00:00:00 GMT', 'last_post_id': 102,
+                                         'last_post_at': datetime(2020, 1, 1, tzinfo=timezone.utc)})
+        # The 304 reached parse rather than being dropped by HttpErrorMiddleware
+        self.assertEqual(visits[1], [{'thread_complete': True, 'url': url}])
+
+
+class RecordThreadVisitTest(SimpleTestCase):
+    now = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+    def visit(self, new_posts, hours_since_visit=1, **fields):
+        state = ThreadState(platform='8kun', board='qresearch', thread_id=100, visited_at=self.now - timedelta(
+            hours=hours_since_visit), last_post_at=self.now - timedelta(hours=hours_since_visit), **fields)
+        record_thread_visit(state, new_posts, self.now)
+        return state
+
+    def test_fast_thread_is_revisited_soon(self):
+        state = self.visit(300, post_count=100, post_rate=300)
+        self.assertEqual(state.status, ThreadStatus.ACTIVE)
+        self.assertEqual(state.post_count, 400)
+        self.assertEqual(state.last_post_at, self.now)
+        self.assertEqual(state.next_visit_at, self.now + timedelta(minutes=5))
+
+    def test_rate_is_smoothed(self):
+        state = self.visit(0, hours_since_visit=2, post_count=100, post_rate=1)
+        self.assertEqual(state.post_rate, 0.5)
+        self.assertEqual(state.status, ThreadStatus.SLOWING)
+        self.assertEqual(state.next_visit_at, self.now + timedelta(hours=12))
+
+    def test_moderate_thread_waits_for_target_posts(self):
+        state = self.visit(10, post_count=100, post_rate=10)
+        self.assertEqual(state.next_visit_at, self.now + timedelta(hours=2.5))
+
+    def test_full_thread_is_bump_locked(self):
+        state = self.visit(50, post_count=740, post_rate=50)
+        self.assertEqual(state.status, ThreadStatus.BUMP_LOCKED)
+        self.assertEqual(state.next_visit_at, self.now + timedelta(hours=12))
+
+    def test_thread_dead_before_its_first_visit(self):
+        state = ThreadState(platform='8kun', board='qresearch', thread_id=100)
+        record_thread_visit(state, 300, self.now, last_post_at=self.now - timedelta(days=30))
+        self.assertEqual(state.last_post_at, self.now - timedelta(days=30))
+        self.assertEqual(state.status, ThreadStatus.DEAD)
+        self.assertIsNone(state.next_visit_at)
+
+    def test_quiet_thread_is_dead(self):
+        state = self.visit(0, hours_since_visit=24 * 3, post_count=100, post_rate=0.1)
+        self.assertEqual(state.status, ThreadStatus.DEAD)
+        self.assertIsNone(state.next_visit_at)
+
+    def test_gone_thread_is_archived(self):
+        state = ThreadState(platform='8kun', board='qresearch', thread_id=100, post_rate=300)
+        record_thread_visit(state, 0, self.now, gone=True)
+        self.assertEqual(state.status, ThreadStatus.ARCHIVED)
+        self.assertIsNone(state.next_visit_at)
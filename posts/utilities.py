@@ -1,101 +1,272 @@
+import hashlib
 import html
+import io
+import json
+import multiprocessing
+import os
 import re
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
 
+import numpy as np
 import pandas as pd
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
 from bs4 import BeautifulSoup
+from lxml import etree
 from tqdm import tqdm
 
+from posts.choices import IngestStatus, ThreadStatus
 from posts.documents import PostDocument, RedditPostDocument
-from posts.models import Post, Board, Platform, Subreddit, RedditPost
+from posts.models import Post, Board, Platform, Subreddit, RedditPost, IngestManifest, ThreadState, \
+    ScrapeJob, PostLink
 
+# Revisit scheduling. A thread is visited again once it's expected to have REVISIT_TARGET_POSTS new posts, but no
+# sooner than MIN_REVISIT_INTERVAL or later than MAX_REVISIT_INTERVAL after its last visit
+REVISIT_TARGET_POSTS = 25
+MIN_REVISIT_INTERVAL = timedelta(minutes=5)
+MAX_REVISIT_INTERVAL = timedelta(hours=12)
+POST_RATE_SMOOTHING = 0.5  # Weight of the latest visit's post rate against the previous estimate
+ACTIVE_POST_RATE = 1.0  # Posts per hour below which a thread is slowing
+BUMP_LIMIT = 752  # Posts after which a thread no longer bumps
+DEAD_AFTER = timedelta(days=3)  # Time without new posts after which a thread is dead
 
-def process_replies(threads):
-    for platform, board, thread in tqdm(threads):
-        s = PostDocument.search()
-        posts = s.query('match', platform__name=platform) \
-            .query('match', board__name=board) \
-            .query('match', thread_id=thread) \
-            .extra(size=752) \
-            .to_queryset()
-        posts_df = pd.DataFrame(posts.values_list('platform__name', 'board__name', 'thread_id', 'post_id', 'links'),
-                                columns=['platform', 'board', 'thread_no', 'post_no', 'links'])
-        replies_df = process_replies_from_df(posts_df)
-        for post in posts:
-            post.replies = replies_df[replies_df.post_no == post.post_id].replies.reset_index(drop=True)[0]
 
-        Post.objects.bulk_update(posts, ['replies'])
+class DimensionCache(object):
+    """
+    In-memory cache of the Platform, Board and Subreddit rows posts point to, keyed by natural key, so loaders don't
+    make a get_or_create round trip per post. Everything is preloaded on first use and missing boards or subreddits
+    are created once per batch.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.platforms = {}
+        self.boards = {}
+        self.subreddits = {}
+
+    def preload(self):
+        self.platforms = {platform.name: platform for platform in Platform.objects.all()}
+        self.boards = {(board.platform_id, board.name): board for board in Board.objects.all()}
+        # Subreddit names aren't unique in the DB, and get_or_create raised MultipleObjectsReturned on a duplicate.
+        # Ordered newest first, so the oldest of the duplicates is the one kept, as it's the one older posts point to
+        self.subreddits = {subreddit.name: subreddit for subreddit in Subreddit.objects.order_by('-id')}
+        self.loaded = True
+
+    def clear(self):
+        """Forget everything, e.g. after rolling back a transaction that created rows."""
+        self.loaded = False
+
+    def platform(self, name):
+        if not self.loaded:
+            self.preload()
+        if name not in self.platforms:
+            self.platforms[name], created = Platform.objects.get_or_create(name=name)
+        return self.platforms[name]
+
+    def boards_for(self, platform, names):
+        """Map each board name on the platform to its Board, bulk-creating any that don't exist yet."""
+        if not self.loaded:
+            self.preload()
+        missing = set(name for name in names if (platform.id, name) not in self.boards)
+        if missing:
+            Board.objects.bulk_create([Board(platform=platform, name=name) for name in missing],
+                                      ignore_conflicts=True)
+            for board in Board.objects.filter(platform=platform, name__in=missing):
+                self.boards[(platform.id, board.name)] = board
+        return {name: self.boards[(platform.id, name)] for name in names}
+
+    def board(self, platform, name):
+        return self.boards_for(platform, [name])[name]
+
+    def subreddits_for(self, names):
+        """Map each subreddit name to its Subreddit, bulk-creating any that don't exist yet."""
+        if not self.loaded:
+            self.preload()
+        missing = set(name for name in names if name not in self.subreddits)
+        if missing:
+            for subreddit in Subreddit.objects.bulk_create([Subreddit(name=name) for name in missing]):
+                self.subreddits[subreddit.name] = subreddit
+        return {name: self.subreddits[name] for name in names}
+
+
+dimensions = DimensionCache()
+
+
+def resolve_post_links(posts):
+    """
+    Set `links` of each post to {'>>N': URL of post N} for the >>N links in its body that point to an archived post
+    on the same board, resolving all of their targets with a single query. Returns the posts whose links changed,
+    with last_modified bumped (bulk_update won't).
+    """
+    targets = []
+    by_board = {}
+    for post in posts:
+        # dict.fromkeys keeps the first appearance of each link, in order
+        links = [link for link in dict.fromkeys(re.findall(r'>>([0-9]+)', post.body)) if int(link) < 2 ** 31]
+        targets.append(links)
+        by_board.setdefault((post.platform_id, post.board_id), set()).update(int(link) for link in links)
+
+    query = Q(pk__in=[])
+    for (platform_id, board_id), post_ids in by_board.items():
+        if post_ids:
+            query |= Q(platform_id=platform_id, board_id=board_id, post_id__in=post_ids)
+    urls = {(linked.platform_id, linked.board_id, linked.post_id): linked.get_post_url() for linked in
+            Post.objects.filter(query).select_related('platform', 'board').only('platform__name', 'board__name',
+                                                                                 'thread_id', 'post_id')}
+
+    changed = []
+    now = timezone.now()
+    for post, post_links in zip(posts, targets):
+        links = {f'>>{link}': urls[(post.platform_id, post.board_id, int(link))] for link in post_links
+                 if (post.platform_id, post.board_id, int(link)) in urls}
+        if links != post.links:
+            post.links = links
+            post.last_modified = now
+            changed.append(post)
+    return changed
+
+
+def process_replies(threads, workers=1):
+    """Rebuild the replies of every post in the given (platform name, board name, thread ID) threads."""
+    boards = {(board.platform.name, board.name): board.id for board in Board.objects.select_related('platform')}
+    return rebuild_replies([(boards[(platform, board)], thread) for platform, board, thread in threads
+                            if (platform, board) in boards], workers=workers)
+
+
+def rebuild_replies(threads, workers=1, batch_size=500):
+    """
+    Rebuild the replies of every post in the given (board ID, thread ID) threads from the posts in Postgres, a batch
+    of whole threads at a time. Batches are read and written here while `workers` processes compute their replies.
+    Only posts whose replies changed are written. Returns how many that was.
+    """
+    boards = {board.id: (board.platform.name, board.name) for board in Board.objects.select_related('platform')}
+
+    def read_batches():
+        for batch in split_list(threads, batch_size):
+            yield (read_thread_posts(batch, boards),)
+
+    updated = 0
+    for changed in tqdm(pipelined_map(changed_replies, read_batches(), workers=workers),
+                        total=-(-len(threads) // batch_size)):
+        Post.objects.bulk_update([Post(id=post_id, replies=replies) for post_id, replies in changed], ['replies'],
+                                 batch_size=10000)
+        updated += len(changed)
+    return updated
+
+
+def read_thread_posts(threads, boards):
+    """All posts of the given (board ID, thread ID) threads, with the columns process_replies_from_df expects."""
+    thread_ids = {}
+    for board_id, thread_id in threads:
+        thread_ids.setdefault(board_id, []).append(thread_id)
+    query = Q(pk__in=[])
+    for board_id, ids in thread_ids.items():
+        query |= Q(board_id=board_id, thread_id__in=ids)
+    df = pd.DataFrame(Post.objects.filter(query).values_list('id', 'board_id', 'thread_id', 'post_id', 'links',
+                                                             'replies'),
+                      columns=['id', 'board_id', 'thread_no', 'post_no', 'links', 'old_replies'])
+    df['platform'] = df.board_id.map(lambda board_id: boards[board_id][0])
+    df['board'] = df.board_id.map(lambda board_id: boards[board_id][1])
+    return df
+
+
+def changed_replies(df):
+    """(post ID, replies) for each post in df whose replies differ from its `old_replies`."""
+    df = process_replies_from_df(df)
+    if len(df) == 0:
+        return []
+    return [(post_id, replies) for post_id, replies, old_replies in zip(df.id, df.replies, df.old_replies)
+            if replies != old_replies]
 
 
 def process_replies_from_df(df):
-    all_replies = {}
-    df_with_replies = pd.DataFrame()
+    """
+    Build each post's `replies` column (a list of [replying post number, replying post URL] sorted by post number,
+    or an empty dict) from the `links` of the other posts in its thread.
 
-    def aggregate_replies(row):
-        def get_post_url(row_):
-            if row_['platform'] == '4chan':
-                return f"/{row_['platform']}/{row_['board']}/res/{row_['thread_no']}.html" + '#' + str(
-                    int(row_['post_no']))
-            else:
-                return f"/{row_['board']}/res/{row_['thread_no']}.html" + '#' + str(int(row_['post_no']))
+    Links are exploded into one row per (source post, link) and parsed with vectorized string operations, so this
+    runs in roughly linear time. Rows come back grouped by thread (in order of first appearance) with the old index
+    in an `index` column, exactly as the original per-thread implementation returned them.
+    """
+    df = df[df.thread_no.notna()]
+    if len(df) == 0:
+        return pd.DataFrame()
+    order = np.argsort(pd.factorize(df.thread_no)[0], kind='stable')
+    df = df.iloc[order].reset_index()
 
+    # One row per (source post, link URL), in post order and then link order
+    def link_urls(links):
         try:
-            for link, url in dict(row['links']).items():
-                try:
-                    if row['platform'] == '4chan':
-                        _, platform, board, _, end = url.split('/')
-                    else:
-                        _, board, _, end = url.split('/')
-                    if '#' in end:
-                        post_no = int(end.split('.')[-1].split('#')[-1])
-                    else:
-                        post_no = int(end.split('.')[0])
-
-                    if post_no in all_replies:
-                        all_replies[post_no].append([str(int(row['post_no'])), get_post_url(row)])
-                    else:
-                        all_replies[post_no] = [[str(int(row['post_no'])), get_post_url(row)]]
-                except Exception as e:
-                    print(e)
-                continue
+            return list(dict(links).values())
         except Exception as e:
-            print(type(row['links']))
-            print(row['links'])
+            print(type(links))
+            print(links)
             print(e)
+            return []
+
+    links = df.links.apply(link_urls).explode().dropna().astype(str)
+    sources = df.loc[links.index]
+    url_parts = links.str.split('/')
+    expected_parts = np.where(sources.platform == '4chan', 5, 4)
+    end = url_parts.str[-1].where(url_parts.str.len() == expected_parts)
+    target = end.str.split('.').str[-1].str.split('#').str[-1] \
+        .where(end.str.contains('#', regex=False, na=False), end.str.split('.').str[0])
+    source_no = _int_strings(sources.post_no)
+    replies = pd.DataFrame({
+        'thread_no': sources.thread_no,
+        'target': pd.to_numeric(target.where(target.str.fullmatch(r'\s*[+-]?[0-9]+\s*', na=False)),
+                                errors='coerce'),
+        'source_no': source_no,
+        'source_url': _post_urls(sources, source_no),
+    }).dropna()
+    replies['target'] = replies.target.astype('int64')
+    replies['reply'] = [[no, url] for no, url in zip(replies.source_no, replies.source_url)]
+    replies = replies.sort_values('source_no', kind='mergesort') \
+        .groupby(['thread_no', 'target'], sort=False).reply.agg(list)
+
+    # Looks hacky but we have to go through float to handle e.g. '8222326.0'
+    post_nos = pd.to_numeric(df.post_no.astype(str), errors='coerce')
+    post_nos = np.trunc(post_nos.where(np.isfinite(post_nos)))
+    keys = pd.MultiIndex.from_arrays([df.thread_no, post_nos.fillna(-1).astype('int64')])
+    matched = replies.reindex(keys).to_numpy()
+    # A post that has replies but whose number doesn't parse as an int (e.g. '6.0') is left without any
+    df['replies'] = [
+        np.nan if pd.isna(no) or (isinstance(replies_, list) and int_no is None)
+        else replies_ if isinstance(replies_, list) else dict()
+        for replies_, no, int_no in zip(matched, post_nos, _int_strings(df.post_no))
+    ]
+    return df
 
-    def link_replies(row):
+
+def _int_strings(values):
+    """str(int(value)) for each value, or None where int() fails (e.g. on '6.0')."""
+    def int_string(value):
         try:
-            if int(float(
-                    row['post_no'])) in all_replies:  # Looks hacky but we have to do this to handle e.g. '8222326.0'
-                row['replies'] = sorted(all_replies[int(row['post_no'])], key=lambda x: x[0])
-            else:
-                row['replies'] = dict()
-            return row
-        except Exception as e:
-            print('Exception linking replies on row:')
-            print(row)
-            print(e)
-            return row
+            return str(int(value))
+        except (TypeError, ValueError, OverflowError):
+            return None
 
-    threads = df.thread_no.unique()
-    for thread in threads:
-        all_replies = {}
-        thread_df = df[df.thread_no == thread].copy().reset_index()
-        if len(thread_df) == 0:
-            continue
-        thread_df.apply(aggregate_replies, axis=1)
-        df_with_replies = pd.concat([df_with_replies, thread_df.apply(link_replies, axis=1)])
-    return df_with_replies.reset_index(drop=True)
+    return pd.Series([int_string(value) for value in values], index=values.index, dtype=object)
+
+
+def _post_urls(df, post_nos):
+    urls = '/' + df.board.map(str) + '/res/' + df.thread_no.map(str) + '.html#' + post_nos
+    return urls.where(df.platform != '4chan', '/' + df.platform.map(str) + urls)
 
 
 def process_and_commit_from_df(df, platform_obj):
     print('Parsing formatting...')
     df['body_text'] = df.body_text.fillna('')
     df['body_html'] = df.body_text
-    df['links'] = df.apply(process_links, axis=1)
+    df['links'] = process_links_from_df(df)[0]
     if platform_obj.name == '8chan':
-        df['body_text'] = df.body_text.apply(parse_8chan_formatting)
+        df['body_text'] = df.body_text.apply(lxml_parse_8chan_formatting)
     else:
-        df['body_text'] = df.body_text.apply(parse_formatting)
+        df['body_text'] = df.body_text.apply(lxml_parse_formatting)
 
     # Prevent processing as decimal
     df['thread_no'] = pd.to_numeric(df['thread_no'], errors='coerce', downcast='integer')
@@ -117,8 +288,9 @@ def process_and_commit_from_df(df, platform_obj):
 
 def commit_posts_from_df(df, platform_obj):
     if platform_obj.name == '8chan':
-        platform_obj, created = Platform.objects.get_or_create(name='8kun')
+        platform_obj = dimensions.platform('8kun')
     df = df.fillna('')
+    boards = dimensions.boards_for(platform_obj, df.board.unique())
     new_posts = []
     threads = set()
     for index, row in tqdm(df.iterrows(), total=len(df)):
@@ -126,7 +298,7 @@ def commit_posts_from_df(df, platform_obj):
             if platform_obj.name == '4chan':
                 row['links'] = dict()
 
-            board, created = Board.objects.get_or_create(platform=platform_obj, name=row['board'])
+            board = boards[row['board']]
 
             threads.add(row['thread_no'])
             post = Post(platform=platform_obj, board=board, thread_id=row['thread_no'],
@@ -136,10 +308,7 @@ def commit_posts_from_df(df, platform_obj):
                         links=row['links'], body_html=row['body_html'], replies=row['replies'])
             new_posts.append(post)
             if len(new_posts) >= 10000:
-                posts_created = Post.objects.bulk_create(new_posts, ignore_conflicts=True)
-                posts_ids = [post.id for post in posts_created]
-                new_posts_qs = Post.objects.filter(id__in=posts_ids)
-                PostDocument().update(new_posts_qs)
+                copy_insert_posts(new_posts)
                 new_posts = []
         except Exception as e:
             print('Failed to create Post object with row:')
@@ -147,14 +316,142 @@ def commit_posts_from_df(df, platform_obj):
             print(e)
             continue
 
+    copy_insert_posts(new_posts)
+
+    return threads
+
+
+def _copy_value(value):
+    """Format a value prepared for the DB as a field of PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (list, tuple)):
+        # Array fields; elements are double-quoted so that commas, braces and spaces survive
+        value = '{' + ','.join('NULL' if element is None else
+                               '"' + str(element).replace('\\', '\\\\').replace('"', '\\"') + '"'
+                               for element in value) + '}'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_insert(objs, returning=('id',)):
+    """
+    Insert unsaved model instances (all of one model) with PostgreSQL's COPY: they are streamed into a temporary
+    staging table, then merged into the model's table with INSERT ... ON CONFLICT DO NOTHING, in their original order.
+
+    Returns the `returning` columns of the rows actually inserted. Unlike bulk_create(ignore_conflicts=True), which
+    can't tell which rows were skipped and so returns objects without primary keys, this gives the new IDs.
+    """
+    if not objs:
+        return []
+    meta = objs[0]._meta
+    fields = [field for field in meta.concrete_fields if not field.primary_key]
+    columns = ', '.join(connection.ops.quote_name(field.column) for field in fields)
+    table = connection.ops.quote_name(meta.db_table)
+    staging = connection.ops.quote_name(f'{meta.db_table}_staging')
+
+    data = io.StringIO()
+    for order, obj in enumerate(objs):
+        values = [field.get_db_prep_save(field.pre_save(obj, True), connection) for field in fields]
+        data.write('\t'.join([str(order)] + [_copy_value(value) for value in values]) + '\n')
+    data.seek(0)
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS '
+                       f'SELECT 0 AS copy_order, {columns} FROM {table} WITH NO DATA')
+        cursor.copy_expert(f'COPY {staging} (copy_order, {columns}) FROM STDIN', data)
+        cursor.execute(f'INSERT INTO {table} ({columns}) SELECT {columns} FROM {staging} ORDER BY copy_order '
+                       f'ON CONFLICT DO NOTHING RETURNING {", ".join(returning)}')
+        rows = cursor.fetchall()
+        # Dropped now too, in case this runs more than once in an outer transaction
+        cursor.execute(f'DROP TABLE {staging}')
+        return rows
+
+
+def copy_insert_and_index(objs, document):
+    """copy_insert the posts, then update the Elasticsearch index with just the ones inserted. Returns their IDs."""
+    ids = [row[0] for row in copy_insert(objs)]
     # Source on ES bulk update pattern:
     # https://github.com/django-es/django-elasticsearch-dsl/issues/32#issuecomment-736046572
-    posts_created = Post.objects.bulk_create(new_posts, ignore_conflicts=True)
-    posts_ids = [post.id for post in posts_created]
-    new_posts_qs = Post.objects.filter(id__in=posts_ids)
-    PostDocument().update(new_posts_qs)
+    if ids:
+        document().update(document.django.model.objects.filter(id__in=ids))
+    return ids
 
-    return threads
+
+def copy_insert_posts(posts):
+    """copy_insert_and_index for Posts, which also saves the PostLinks of the ones inserted. Returns their IDs."""
+    with transaction.atomic():
+        rows = copy_insert(posts, returning=('id', 'links'))
+        save_post_links(rows)
+    ids = [row[0] for row in rows]
+    if ids:
+        PostDocument().update(Post.objects.filter(id__in=ids))
+    return ids
+
+
+# A link to a thread or a post in one, as in `links`: /board/res/123.html#456, or /4chan/board/res/... for 4chan
+_post_link_url = re.compile(r'(?:/(4chan))?/([a-zA-Z0-9]+)/res/([0-9]+)\.html(?:#q?([0-9]+))?')
+
+
+def save_post_links(posts):
+    """Replace the PostLinks of (post ID, links) pairs with the thread and post links in `links`."""
+    post_ids = []
+    edges = []
+    for post_id, links in posts:
+        post_ids.append(post_id)
+        if isinstance(links, str):
+            # Raw query results aren't decoded
+            links = json.loads(links)
+        for url in links.values():
+            match = _post_link_url.fullmatch(str(url))
+            if match is None:
+                continue
+            platform, board, thread_id, target_post_id = match.groups()
+            if int(thread_id) >= 2 ** 31 or (target_post_id is not None and int(target_post_id) >= 2 ** 31):
+                continue
+            edges.append(PostLink(post_id=post_id, target_platform=platform, target_board=board,
+                                  target_thread_id=int(thread_id),
+                                  target_post_id=None if target_post_id is None else int(target_post_id)))
+    with transaction.atomic():
+        PostLink.objects.filter(post_id__in=post_ids).delete()
+        copy_insert(edges)
+    return edges
+
+
+class BackgroundIndexer(object):
+    """
+    Update a document's Elasticsearch index with batches of newly inserted rows on a background thread, so loading
+    can go on while ES catches up. Use it as a context manager: leaving the block waits for every queued batch and
+    raises the first error any of them hit.
+    """
+
+    def __init__(self, document, batch_size=10000):
+        self.document = document
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # The thread has its own DB connection
+        self.executor.submit(connections.close_all)
+        self.executor.shutdown(wait=True)
+        if exc_type is None:
+            while self.pending:
+                self.pending.popleft().result()
+
+    def add(self, ids):
+        for batch in split_list(ids, self.batch_size):
+            self.pending.append(self.executor.submit(self.index, batch))
+        # Surface errors early
+        while self.pending and self.pending[0].done():
+            self.pending.popleft().result()
+
+    def index(self, ids):
+        self.document().update(self.document.django.model.objects.filter(id__in=ids))
 
 
 def parse_archive_is(row):
@@ -203,6 +500,94 @@ def parse_archive_is(row):
         raise e
 
 
+# archive.is inlines 8chan's CSS, so header fields can only be told apart by their exact style attributes
+_archive_is_header_xpaths = {
+    'name': [etree.XPath('(.//span[@style="text-align:left;color:rgb(17, 119, 67);font-weight:bold;"])[1]'),
+             etree.XPath('(.//span[@style="text-align:left;font-weight:bold;color:rgb(52, 52, 92);"])[1]')],
+    'subject': [etree.XPath('(.//span[@style="text-align:left;color:rgb(15, 12, 93);font-weight:bold;"])[1]')],
+    'timestamp': [etree.XPath('(.//time)[1]')],
+    'poster_id': [etree.XPath('(.//span[@style="text-align:left;cursor:pointer;white-space:nowrap;"])[1]')],
+    'tripcode': [etree.XPath('(.//span[@style="text-align:left;color:rgb(34, 136, 84);"])[1]')],
+    'post_no': [etree.XPath('(.//a[@style="text-align:left;text-decoration:none;color:inherit;'
+                            'margin: 0px; padding: 0px; "])[2]')],
+}
+_archive_is_header_tag = 'dchan-archive-is-header'
+
+
+def _soup_text(element):
+    """An lxml element's text as BeautifulSoup's get_text() would return it."""
+    parts = [element.text] if element.text else []
+    for child in element:
+        if isinstance(child.tag, str):
+            parts.append(_soup_text(child))
+        if child.tail:
+            parts.append(child.tail)
+    return ''.join(_collapse_blank(part, False) for part in parts)
+
+
+def _parse_archive_is_header(header):
+    fields = {}
+    for field, xpaths in _archive_is_header_xpaths.items():
+        for xpath in xpaths:
+            found = xpath(header)
+            if found:
+                fields[field] = _soup_text(found[0])
+                break
+        else:
+            fields[field] = None
+
+    for required in ['name', 'timestamp', 'post_no']:
+        if fields[required] is None:
+            raise ValueError(f'missing {required}')
+    if fields['poster_id'] is not None:
+        if not fields['poster_id'].split():
+            raise ValueError('empty poster_id')
+        fields['poster_id'] = fields['poster_id'].split()[-1]
+    else:  # /patriotsfight/ apparently had poster IDs turned off
+        fields['poster_id'] = ''
+    for field in ['name', 'subject', 'timestamp', 'tripcode', 'post_no']:
+        fields[field] = (fields[field] or '').rstrip()
+    return fields
+
+
+def parse_archive_is_headers(df, batch_size=1000):
+    """
+    Batch equivalent of applying parse_archive_is to every row of df: the headers of up to `batch_size` rows are
+    parsed together in a single lxml call and their fields located with precompiled XPath expressions.
+
+    Rows whose header can't be parsed are dropped rather than raising. Returns the parsed DataFrame and a Counter
+    of failures keyed by reason (e.g. 'missing name'), so callers can report them and carry on.
+    """
+    records = []
+    failures = Counter()
+    for start in range(0, len(df), batch_size):
+        batch = df.iloc[start:start + batch_size]
+        headers = ''.join(f'<{_archive_is_header_tag}>{header}</{_archive_is_header_tag}>'
+                          for header in batch.header.fillna(''))
+        root = etree.fromstring(f'<html><body>{headers}</body></html>', _lxml_parser)
+        elements = root.findall(f'.//{_archive_is_header_tag}')
+        if len(elements) != len(batch):
+            # A header broke out of its wrapper, so fall back to parsing this batch one header at a time
+            elements = [etree.fromstring(f'<{_archive_is_header_tag}>{header}</{_archive_is_header_tag}>',
+                                         _lxml_parser).find(f'.//{_archive_is_header_tag}')
+                        for header in batch.header.fillna('')]
+
+        for element, board, platform, thread_no, body in zip(elements, batch.board, batch.platform,
+                                                               batch.thread_no, batch.body):
+            try:
+                fields = _parse_archive_is_header(element)
+            except ValueError as e:
+                failures[str(e)] += 1
+                continue
+            fields.update({'board': board, 'platform': platform, 'thread_no': thread_no, 'body_text': body})
+            records.append(fields)
+
+    parsed = pd.DataFrame(records, columns=['name', 'subject', 'timestamp', 'poster_id', 'tripcode', 'post_no',
+                                            'board', 'platform', 'thread_no', 'body_text'])
+    parsed['timestamp'] = parsed.timestamp.str.split('(').str[0] + parsed.timestamp.str.split(r'\) ').str[-1]
+    return parsed, failures
+
+
 def parse_formatting(html):
     soup = BeautifulSoup(html, 'html.parser')
 
@@ -278,6 +663,357 @@ def process_links(row):
         return {}
 
 
+# The patterns process_links uses, per platform: (links to posts, links to board indexes)
+_link_patterns = {
+    '8chan': (
+        re.compile(r'\/([a-zA-Z0-9]+)\/res\/([0-9]+)\.html%23([0-9]+)\".{80,95}>'
+                   r'(&gt;&gt;[0-9]+|&gt;&gt;&gt;\/[a-zA-Z]+\/[0-9]+)'),
+        re.compile(r'\/([a-zA-Z0-9]+)\/index\.html\".{80,95}>(&gt;&gt;[0-9]+|&gt;&gt;&gt;/[a-zA-Z]+/)'),
+    ),
+    'default': (
+        re.compile(r'\"\/([a-zA-Z0-9]+)\/res\/([0-9]+)\.html#q?([0-9]+)\">'
+                   r'(&gt;&gt;[0-9]+|&gt;&gt;&gt;\/[a-zA-Z]+\/[0-9]+)'),
+        re.compile(r'\"\/([a-zA-Z0-9]+)\/index\.html\">(&gt;&gt;[0-9]+|&gt;&gt;&gt;/[a-zA-Z]+/)'),
+    ),
+}
+
+
+def process_links_from_df(df):
+    """
+    Batch equivalent of applying process_links to every row of df, matching precompiled patterns against the whole
+    `body_text` column at once.
+
+    Returns the `links` Series ({'>>123': url} dicts, aligned with df) and a DataFrame of link records with one row
+    per match: `row` (position in df), `kind` ('post' or 'board'), target `board`, `thread` and `post` (missing for
+    board links), the link `text` and its `url`.
+    """
+    body = df.body_text.reset_index(drop=True)
+    platform = df.platform.reset_index(drop=True)
+    records = []
+    for name, (post_pattern, board_pattern) in _link_patterns.items():
+        in_group = platform == '8chan' if name == '8chan' else platform != '8chan'
+        group_body = body[in_group & body.map(lambda b: isinstance(b, str))]
+        if len(group_body) == 0:
+            continue
+
+        posts = group_body.str.extractall(post_pattern)
+        posts.columns = ['board', 'thread', 'post', 'text']
+        posts['kind'] = 'post'
+        posts['url'] = '/' + posts.board + '/res/' + posts.thread + '.html#' + posts.post
+
+        boards = group_body.str.extractall(board_pattern)
+        boards.columns = ['board', 'text']
+        boards['kind'] = 'board'
+        boards['url'] = '/' + platform.reindex(boards.index.get_level_values(0)).to_numpy() + '/' + boards.board + '/'
+
+        # Post links come before board links for each row, as in process_links
+        for order, matches in enumerate([posts, boards]):
+            matches = matches.reset_index().rename(columns={'level_0': 'row'})
+            matches['order'] = order
+            records.append(matches)
+
+    columns = ['row', 'kind', 'board', 'thread', 'post', 'text', 'url']
+    if records:
+        records = pd.concat(records).sort_values(['row', 'order', 'match'], kind='mergesort')
+        records = records.reindex(columns=columns).reset_index(drop=True)
+        records['text'] = records.text.str.replace('&gt;', '>', regex=False)  # The only entity the patterns allow
+    else:
+        records = pd.DataFrame(columns=columns)
+
+    links = [dict() for _ in range(len(df))]
+    for row, text, url in zip(records.row, records.text, records.url):
+        links[row][text] = url
+    return pd.Series(links, index=df.index, dtype=object), records
+
+
+def pipelined_map(func, tasks, workers=1, queue_size=None, initializer=None, initargs=()):
+    """
+    Yield func(*task) for every task, in order, while up to `workers` processes work ahead of the consumer.
+
+    At most `queue_size` tasks (default: twice the workers) are pulled from `tasks` and held in flight at once, so
+    a lazy producer, the process pool and the consumer (usually a single DB committer) all stay bounded. With one
+    worker everything runs serially in this process.
+    """
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for task in tasks:
+            yield func(*task)
+        return
+
+    queue_size = queue_size or workers * 2
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'),
+                             initializer=initializer, initargs=initargs) as executor:
+        pending = deque()
+        for i, task in enumerate(tasks):
+            if i == 0:
+                # Workers are forked on the first submit and must not share the parent's DB connection, which the
+                # producer may already have used. Django reconnects lazily afterwards
+                connections.close_all()
+            if len(pending) >= queue_size:
+                yield pending.popleft().result()
+            pending.append(executor.submit(func, *task))
+        while pending:
+            yield pending.popleft().result()
+
+
+def read_csv_thread_chunks(file, thread_column, chunksize, **kwargs):
+    """
+    Read a CSV lazily in chunks of roughly `chunksize` rows, never splitting a thread across two chunks. Rows of the
+    trailing thread of each chunk are held back and prepended to the next one, so this relies on each thread's rows
+    being contiguous in the file (as they are in our scrapes). A thread longer than `chunksize` becomes one chunk.
+    """
+    carry = None
+    for chunk in pd.read_csv(file, chunksize=chunksize, **kwargs):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk])
+        threads = chunk[thread_column].to_numpy()
+        breaks = np.flatnonzero(threads != threads[-1])
+        if len(breaks) == 0:
+            carry = chunk
+            continue
+        carry = chunk.iloc[breaks[-1] + 1:]
+        yield chunk.iloc[:breaks[-1] + 1]
+    if carry is not None and len(carry) > 0:
+        yield carry
+
+
+def file_digest(path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ingest_manifest(path, force=False):
+    """
+    Get or create the IngestManifest of a data file. It's keyed by the file's size and content hash as well as its path,
+    so a file that was changed since it was loaded is loaded again. Returns None if the file was already loaded,
+    unless `force` is set, in which case the file is loaded again from the start.
+    """
+    manifest, created = IngestManifest.objects.get_or_create(path=path, size=os.path.getsize(path),
+                                                             content_hash=file_digest(path))
+    if force and not created:
+        manifest.status = IngestStatus.IN_PROGRESS
+        manifest.rows_committed = 0
+        manifest.save()
+    if manifest.status == IngestStatus.COMPLETE:
+        return None
+    return manifest
+
+
+def add_force_argument(parser):
+    """The --force option of the loaders that keep an ingest manifest."""
+    parser.add_argument('--force', action='store_true',
+                        help='Load files again even if the ingest manifest records them as loaded')
+
+
+def start_ingest(path, force=False):
+    """ingest_manifest for a loader about to load the file, saying whether it's skipped or resumed."""
+    manifest = ingest_manifest(path, force)
+    if manifest is None:
+        print(f'Already loaded {path}, skipping. Use --force to load it again.')
+        return None
+    print(f'Loading {path}...')
+    if manifest.rows_committed:
+        print(f'Resuming after row {manifest.rows_committed}...')
+    return manifest
+
+
+def record_ingest_progress(manifest, rows_committed, complete=False):
+    """
+    Record that the first `rows_committed` rows of the manifest's file are in the DB, and whether that's all of them.
+    """
+    manifest.rows_committed = rows_committed
+    if complete:
+        manifest.status = IngestStatus.COMPLETE
+    manifest.save(update_fields=['rows_committed', 'status', 'last_modified'])
+
+
+def thread_states(platform_name, threads):
+    """
+    Get the ThreadStates of (board name, thread ID) pairs on a platform, keyed by them. A thread without one gets an
+    unsaved state started from the posts already archived from it, so that revisiting a thread archived some other
+    way is incremental and scheduled by its history too.
+    """
+    query = Q(pk__in=[])
+    for board in set(board for board, _ in threads):
+        query |= Q(board=board, thread_id__in=[thread_id for board_, thread_id in threads if board_ == board])
+    states = {(state.board, state.thread_id): state
+              for state in ThreadState.objects.filter(query, platform=platform_name)}
+
+    missing = [thread for thread in threads if thread not in states]
+    query = Q(pk__in=[])
+    for board in set(board for board, _ in missing):
+        query |= Q(board__name=board, thread_id__in=[thread_id for board_, thread_id in missing if board_ == board])
+    archived = Post.objects.filter(query, platform__name=platform_name).values('board__name', 'thread_id') \
+        .annotate(last_post_id=Max('post_id'), post_count=Count('id'), first_post_at=Min('timestamp'),
+                  last_post_at=Max('timestamp'))
+    archived = {(thread['board__name'], thread['thread_id']): thread for thread in archived}
+    for board, thread_id in missing:
+        state = ThreadState(platform=platform_name, board=board, thread_id=thread_id)
+        thread = archived.get((board, thread_id))
+        if thread is not None:
+            state.last_post_id = thread['last_post_id']
+            state.post_count = thread['post_count']
+            state.last_post_at = thread['last_post_at']
+            hours = (thread['last_post_at'] - thread['first_post_at']).total_seconds() / 3600
+            if hours > 0:
+                state.post_rate = (thread['post_count'] - 1) / hours
+        states[(board, thread_id)] = state
+    return states
+
+
+def record_thread_visit(state, new_posts, now, gone=False, last_post_at=None):
+    """
+    Update a thread's state after a visit that found `new_posts` posts, the newest made at `last_post_at`, then
+    classify it and schedule the next.
+    """
+    state.post_count += new_posts
+    if new_posts:
+        # When the newest post was made rather than now, so a thread that was already dead on its first visit is
+        # never revisited
+        state.last_post_at = last_post_at or now
+    elif state.last_post_at is None:
+        state.last_post_at = now
+    if state.visited_at is not None:
+        hours = max((now - state.visited_at).total_seconds() / 3600, 1 / 60)
+        if state.post_rate is None:
+            state.post_rate = new_posts / hours
+        else:
+            state.post_rate = POST_RATE_SMOOTHING * new_posts / hours + (1 - POST_RATE_SMOOTHING) * state.post_rate
+    state.visited_at = now
+
+    if gone:
+        state.status = ThreadStatus.ARCHIVED
+    elif now - state.last_post_at >= DEAD_AFTER:
+        state.status = ThreadStatus.DEAD
+    elif state.post_count >= BUMP_LIMIT:
+        state.status = ThreadStatus.BUMP_LOCKED
+    elif state.post_rate is None or state.post_rate >= ACTIVE_POST_RATE:
+        state.status = ThreadStatus.ACTIVE
+    else:
+        state.status = ThreadStatus.SLOWING
+
+    if state.status in (ThreadStatus.ARCHIVED, ThreadStatus.DEAD):
+        state.next_visit_at = None
+    elif state.status == ThreadStatus.BUMP_LOCKED or state.post_rate == 0:
+        # Bump-locked threads only get the odd late post before they fall off the board
+        state.next_visit_at = now + MAX_REVISIT_INTERVAL
+    elif state.post_rate is None:
+        # Nothing to go on yet; the next visit measures the rate
+        state.next_visit_at = now + MIN_REVISIT_INTERVAL
+    else:
+        interval = timedelta(hours=REVISIT_TARGET_POSTS / state.post_rate)
+        state.next_visit_at = now + min(max(interval, MIN_REVISIT_INTERVAL), MAX_REVISIT_INTERVAL)
+
+
+def save_thread_states(states):
+    """Save thread_states() states after a visit: the new ones in one insert, the rest in one update."""
+    now = timezone.now()
+    for state in states:
+        state.last_modified = now
+    ThreadState.objects.bulk_create([state for state in states if state.pk is None], ignore_conflicts=True)
+    ThreadState.objects.bulk_update([state for state in states if state.pk is not None],
+                                    ['etag', 'last_modified_header', 'last_post_id', 'post_count', 'last_post_at',
+                                     'post_rate', 'status', 'visited_at', 'next_visit_at', 'last_modified'])
+
+
+def claim_scrape_jobs(source, limit, lease):
+    """
+    Claim up to `limit` of a source's unleased jobs, highest bounty first, leasing them for `lease` (a timedelta).
+    Rows being claimed by someone else at the same time are skipped rather than waited on, so any number of
+    schedulers can claim at once without two of them getting the same job.
+
+    Returns the claimed IDs and their leased_until, which identifies the claim: whoever holds the jobs passes it to
+    renew_scrape_job_leases, and only touches the rows that still carry it.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        ids = list(ScrapeJob.objects.select_for_update(skip_locked=True)
+                   .filter(Q(leased_until__isnull=True) | Q(leased_until__lt=now), source=source, error_count__lt=2)
+                   .order_by('-bounty').values_list('id', flat=True)[:limit])
+        ScrapeJob.objects.filter(id__in=ids).update(leased_until=now + lease)
+    return ids, now + lease
+
+
+def renew_scrape_job_leases(job_ids, leased_until, lease=None):
+    """
+    Extend the lease on those of the jobs that are still held under the claim `leased_until`, by `lease` (a timedelta,
+    SCRAPE_JOB_LEASE_SECONDS by default) from now. Jobs whose lease ran out and were claimed again belong to the new
+    claim and are left alone. With no `leased_until` (a spider started by hand), claims the jobs that aren't leased.
+
+    Returns the new leased_until and the IDs of the jobs still held.
+    """
+    now = timezone.now()
+    if lease is None:
+        lease = timedelta(seconds=settings.SCRAPE_JOB_LEASE_SECONDS)
+    held = Q(leased_until=leased_until) if leased_until is not None else \
+        Q(leased_until__isnull=True) | Q(leased_until__lt=now)
+    with transaction.atomic():
+        ids = list(ScrapeJob.objects.select_for_update().filter(held, pk__in=job_ids).values_list('id', flat=True))
+        ScrapeJob.objects.filter(id__in=ids).update(leased_until=now + lease)
+    return now + lease, ids
+
+
+def upsert_scrape_jobs(jobs, update_fields=('bounty', 'url', 'source'), batch_size=1000):
+    """
+    Create scrape jobs for the rows of a DataFrame (platform, board, thread_id, url, bounty, job_type, source), or
+    update `update_fields` of the jobs that already exist for their threads, with one INSERT ... ON CONFLICT DO UPDATE
+    per batch. Returns the numbers of jobs created and updated.
+    """
+    # A row can only be upserted once per statement
+    jobs = jobs.drop_duplicates(['platform', 'board', 'thread_id'])
+    table = connection.ops.quote_name(ScrapeJob._meta.db_table)
+    updates = ', '.join(f'{field} = EXCLUDED.{field}' for field in list(update_fields) + ['last_modified'])
+    now = timezone.now()
+    created = 0
+    columns = [('platform', str), ('board', str), ('thread_id', int), ('url', str), ('bounty', int),
+               ('job_type', str), ('source', str)]
+    with connection.cursor() as cursor:
+        for start in range(0, len(jobs), batch_size):
+            batch = jobs.iloc[start:start + batch_size]
+            # Each column goes in as an array, and xmax is 0 in rows that were inserted rather than updated
+            cursor.execute(f'INSERT INTO {table} ({", ".join(column for column, _ in columns)}, error_count, '
+                           f'created_at, last_modified) '
+                           f'SELECT *, 0, %s, %s FROM unnest(%s::varchar[], %s::varchar[], %s::integer[], '
+                           f'%s::varchar[], %s::integer[], %s::varchar[], %s::varchar[]) '
+                           f'ON CONFLICT (platform, board, thread_id) DO UPDATE SET {updates} '
+                           f'RETURNING xmax = 0',
+                           [now, now] + [[cast(value) for value in batch[column]] for column, cast in columns])
+            created += sum(inserted for inserted, in cursor.fetchall())
+    return created, len(jobs) - created
+
+
+def catalog_post_ids(platform_obj):
+    """
+    Catalog the post IDs already archived on a platform as {board name: sorted int64 array}. At 8 bytes a post this is
+    a fraction of the size of a set of "board/post_id" strings, and the rows are streamed rather than built as tuples.
+    """
+    catalog = {}
+    for board in Board.objects.filter(platform=platform_obj):
+        post_ids = Post.objects.filter(platform=platform_obj, board=board).values_list('post_id', flat=True)
+        catalog[board.name] = np.sort(np.fromiter(post_ids.iterator(chunk_size=100000), dtype=np.int64))
+    return catalog
+
+
+def archived_mask(catalog, boards, post_nos):
+    """Boolean array marking which (board, post number) pairs are in a catalog_post_ids() catalog."""
+    post_nos = pd.to_numeric(pd.Series(post_nos), errors='coerce').to_numpy()
+    boards = pd.Series(boards).to_numpy()
+    archived = np.zeros(len(post_nos), dtype=bool)
+    for board in pd.unique(boards):
+        post_ids = catalog.get(board)
+        if post_ids is None or len(post_ids) == 0:
+            continue
+        rows = np.flatnonzero((boards == board) & ~np.isnan(post_nos))
+        values = post_nos[rows].astype(np.int64)
+        found = np.minimum(np.searchsorted(post_ids, values), len(post_ids) - 1)
+        archived[rows] = post_ids[found] == values
+    return archived
+
+
 def split_list(lst, n):
     from itertools import islice
     lst = iter(lst)
@@ -330,11 +1066,123 @@ def parse_8chan_formatting(html):
     return final_text
 
 
+# Inline styles archive.is uses in place of 8chan's quote and heading classes
+ARCHIVE_IS_QUOTE_STYLE = 'text-align:left;color:rgb(120, 153, 34);direction:ltr;display:block;line-height:1.16em;' \
+                         'font-size:13px;min-height:1.16em;margin: 0px; '
+ARCHIVE_IS_HEADING_STYLE = 'text-align:left;color:rgb(175, 10, 15);font-size:11pt;font-weight:bold;'
+
+_lxml_parser = etree.HTMLParser()
+
+# Tags that lxml's parser leaves in place, as html.parser does: inline ones, and the <p> and <div> lines themselves as
+# long as no block is nested in a <p>. lxml moves block elements (<pre> code blocks, <div>, lists, a nested <p> and so
+# on) out of an enclosing <p> and drops their text from the line, and it turns \r\n into \n, so bodies with any of
+# those go through the BeautifulSoup converters instead
+LXML_SAFE_TAGS = {'a', 'abbr', 'b', 'bdi', 'bdo', 'big', 'br', 'cite', 'code', 'data', 'del', 'dfn', 'div', 'em',
+                  'font', 'i', 'img', 'ins', 'kbd', 'mark', 'nobr', 'p', 'q', 's', 'samp', 'small', 'span', 'strike',
+                  'strong', 'sub', 'sup', 'time', 'tt', 'u', 'var', 'wbr'}
+_tag_name = re.compile(r'</?([a-zA-Z][^\s/>]*)')
+_block_in_p = re.compile(r'<p\b[^>]*>(?:(?!</p\s*>).)*?<(?:p|div)\b', re.IGNORECASE | re.DOTALL)
+
+
+def _has_class(element, name):
+    return name in (element.get('class') or '').split()
+
+
+def _collapse_blank(string, preserve_whitespace):
+    # BeautifulSoup replaces strings of nothing but ASCII whitespace with a single newline or space
+    if preserve_whitespace or string.strip(' \n\t\f\r'):
+        return string
+    return '\n' if '\n' in string else ' '
+
+
+def _lxml_keeps_text(markup):
+    """Whether lxml parses the markup into the same tree and text as html.parser, for the converters below."""
+    if '\r' in markup:
+        return False
+    if any(name.lower() not in LXML_SAFE_TAGS for name in _tag_name.findall(markup)):
+        return False
+    return _block_in_p.search(markup) is None
+
+
+def _lxml_to_markup(markup, is_quote, is_heading, is_line):
+    """
+    Single-pass equivalent of parse_formatting/parse_8chan_formatting on lxml's C parser. Instead of inserting
+    markers into the tree with one find_all walk per kind of formatting, every element's markers are worked out
+    while its text is collected, in the same order (heading, bold, italic, underline, strikethrough, spoiler) that
+    the BeautifulSoup versions insert them.
+    """
+    if not markup or not markup.strip():
+        return ''
+    root = etree.fromstring(markup, _lxml_parser)
+    if root is None:
+        return ''
+
+    def markers(element):
+        tag = element.tag
+        opening = []
+        if is_heading(element):
+            opening.append('==')
+        if tag == 'strong':
+            opening.append("'''")
+        elif tag == 'em' and not is_url_slashes(element):  # For some reason, the // in URLs is wrapped with <em />
+            opening.append("''")
+        elif tag == 'u':
+            opening.append('__')
+        elif tag == 's':
+            opening.append('~~')
+        if _has_class(element, 'spoiler'):
+            opening.append('**')
+        return ''.join(opening), ''.join(reversed(opening))
+
+    def is_url_slashes(element):
+        # Quote and heading markers inside the <em /> (and bold ones) were already there when the BeautifulSoup
+        # versions compared its text to '//'
+        if element.xpath('string()') != '//' or is_quote(element):
+            return False
+        return not any(is_quote(child) or is_heading(child) or child.tag == 'strong'
+                       for child in element.iterdescendants() if isinstance(child.tag, str))
+
+    def text(element, preserve_whitespace=False):
+        preserve_whitespace = preserve_whitespace or element.tag in ('pre', 'textarea')
+        parts = ['> '] if is_quote(element) else []
+        if element.text:
+            parts.append(_collapse_blank(element.text, preserve_whitespace))
+        for child in element:
+            if isinstance(child.tag, str):  # Comments and processing instructions contribute only their tails
+                opening, closing = markers(child)
+                parts.extend((opening, text(child, preserve_whitespace), closing))
+            if child.tail:
+                parts.append(_collapse_blank(child.tail, preserve_whitespace))
+        return ''.join(parts)
+
+    return '\n'.join(text(element) for element in root.iter(tag=etree.Element) if is_line(element))
+
+
+def lxml_parse_formatting(html):
+    if html and not _lxml_keeps_text(html):
+        return parse_formatting(html)
+    return _lxml_to_markup(html,
+                           is_quote=lambda element: _has_class(element, 'quote'),
+                           is_heading=lambda element: _has_class(element, 'heading'),
+                           is_line=lambda element: _has_class(element, 'body-line'))
+
+
+def lxml_parse_8chan_formatting(html):
+    if html and not _lxml_keeps_text(html):
+        return parse_8chan_formatting(html)
+    return _lxml_to_markup(html,
+                           is_quote=lambda element: element.get('style') == ARCHIVE_IS_QUOTE_STYLE,
+                           is_heading=lambda element: element.get('style') == ARCHIVE_IS_HEADING_STYLE,
+                           is_line=lambda element: element.tag == 'div')
+
+
 def commit_reddit_posts_from_df(df):
     new_posts = []
-    for index, row in tqdm(df.iterrows(), total=len(df)):
-        subreddit, created = Subreddit.objects.get_or_create(name=row['subreddit'])
-        reddit, created = Platform.objects.get_or_create(name='reddit')
+    posts_ids = []
+    reddit = dimensions.platform('reddit')
+    subreddits = dimensions.subreddits_for(df.subreddit.unique())
+    for row in tqdm(df.to_dict('records')):
+        subreddit = subreddits[row['subreddit']]
 
         post = RedditPost(subreddit=subreddit, timestamp=row['created_utc'], edited=row['edited'],
                           author_flair_text=row['author_flair_text'], stickied=row['stickied'],
@@ -347,17 +1195,9 @@ def commit_reddit_posts_from_df(df):
                           parent_id=row['parent_id'], platform=reddit)
         new_posts.append(post)
         if len(new_posts) >= 10000:
-            posts_created = RedditPost.objects.bulk_create(new_posts)
-            posts_ids = [post.id for post in posts_created]
-            new_posts_qs = RedditPost.objects.filter(id__in=posts_ids)
-            RedditPostDocument().update(new_posts_qs)
+            posts_ids.extend(copy_insert_and_index(new_posts, RedditPostDocument))
             new_posts = []
 
-    # Source on ES bulk update pattern:
-    # https://github.com/django-es/django-elasticsearch-dsl/issues/32#issuecomment-736046572
-    posts_created = RedditPost.objects.bulk_create(new_posts)
-    posts_ids = [post.id for post in posts_created]
-    new_posts_qs = RedditPost.objects.filter(id__in=posts_ids)
-    RedditPostDocument().update(new_posts_qs)
+    posts_ids.extend(copy_insert_and_index(new_posts, RedditPostDocument))
 
     return posts_ids
@@ -1,59 +1,127 @@
 import pandas as pd
+from django.db.models import F
+from django.utils import timezone
 
 from posts import utilities
-from posts.models import Platform, JobType
+from posts.models import JobType, ScrapeJob
 from posts.utilities import process_replies
 
 
-class ArchiveIsPipeline(object):
-    def process_item(self, item, spider):
-        if 'archive.' not in spider.jobs.first().url:
-            return item
-        else:
-            return utilities.parse_archive_is(item)
-
-
 class ScrapyPostPipeline(object):
-    def __init__(self, *args, **kwargs):
-        self.start_urls = []
-        self.posts = []
+    """
+    Buffers scraped posts per thread and commits threads in batches while the crawl runs, as spiders mark them
+    complete (see THREAD_FLUSH_SIZE), so a crash only loses the threads not yet flushed.
+    """
+
+    def __init__(self, flush_size=5):
+        self.flush_size = flush_size
         self.scraped_urls = set()
-        self.df = pd.DataFrame()
+        self.threads = {}  # Thread URL -> posts (dicts) scraped from it
+        self.completed_urls = []
+        self.completions = {}  # Thread URL -> the spider's thread_complete item
 
-    def open_spider(self, spider):
-        self.start_urls = spider.start_urls
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(flush_size=crawler.settings.getint('THREAD_FLUSH_SIZE', 5))
 
     def process_item(self, item, spider):
+        if item.get('thread_complete'):
+            # Yielded by the spider after the last post of a thread
+            self.completed_urls.append(item['url'])
+            self.completions[item['url']] = dict(item)
+            if len(self.completed_urls) >= self.flush_size:
+                urls, self.completed_urls = self.completed_urls, []
+                self.flush(spider, urls)
+            return item
+
         if 'url' in item:
             self.scraped_urls.add(item['url'])
-        self.df = self.df.append(item, ignore_index=True)
+        self.threads.setdefault(item.get('url'), []).append(dict(item))
         return item
 
-    def close_spider(self, spider):
+    def flush(self, spider, urls):
+        """
+        Commit the posts of the threads at these URLs, then finish their jobs. If the commit fails, their jobs are
+        failed instead, and their posts are kept to be tried again when the spider closes.
+        """
+        if not urls:
+            return
+        new_posts = {url: len(self.threads.get(url, [])) for url in urls}
+        posts = [post for url in urls for post in self.threads.get(url, [])]
+        print(f'Committing {len(posts)} posts from {len(urls)} threads...')
+        urls = set(urls)
         try:
-            if len(self.df) == 0:
+            self.commit(pd.DataFrame(posts), spider)
+        except Exception as e:
+            print(f'Failed to commit {len(urls)} threads:')
+            print(e)
+            spider.failed_job_ids.update(job.id for job in spider.jobs.values() if job.url in urls)
+            # Without their completions, a retry doesn't record the visit, so the next one fetches the posts again
+            self.completed_urls = [url for url in self.completed_urls if url not in urls]
+            for url in urls:
+                self.completions.pop(url, None)
+            return
+
+        for url in urls:
+            self.threads.pop(url, None)
+        finished_jobs = [job for job in spider.jobs.values() if job.url in urls]
+        threads_to_reprocess = []
+        states = []
+        now = timezone.now()
+        for job in finished_jobs:
+            if job.job_type == JobType.REVISIT and new_posts[job.url]:
+                # Revisits that came back unchanged have no new replies to process
+                threads_to_reprocess.append((job.platform, job.board, job.thread_id))
+            completion = self.completions.pop(job.url, {})
+            state = getattr(spider, 'thread_states', {}).get((job.board, job.thread_id))
+            if state is not None and completion:
+                for field in ('etag', 'last_modified_header', 'last_post_id'):
+                    if field in completion:
+                        setattr(state, field, completion[field])
+                utilities.record_thread_visit(state, new_posts[job.url], now, gone=completion.get('gone', False),
+                                              last_post_at=completion.get('last_post_at'))
+                states.append(state)
+        process_replies(threads_to_reprocess)
+        utilities.save_thread_states(states)
+        # Jobs claimed again since belong to the new claim, and are left for it to finish
+        ScrapeJob.objects.filter(pk__in=[job.id for job in finished_jobs], leased_until=spider.lease).delete()
+        for job in finished_jobs:
+            del spider.jobs[job.id]
+
+        # Keep the lease on the jobs left while the crawl makes progress, and let go of any that were claimed again
+        spider.lease, held_ids = utilities.renew_scrape_job_leases(list(spider.jobs), spider.lease)
+        for job_id in set(spider.jobs) - set(held_ids):
+            del spider.jobs[job_id]
+
+    def commit(self, df, spider):
+        if len(df) == 0:
+            return
+        if 'header' in df:
+            # Scraped from archive.is; parse all of the post headers in one batch
+            df, failures = utilities.parse_archive_is_headers(df)
+            if failures:
+                print(f'Skipped {sum(failures.values())} posts with unparseable headers: {dict(failures)}')
+            if len(df) == 0:
                 return
-            self.df['platform'] = spider.platform
-            platform_obj = Platform.objects.get(name=spider.platform)
-            if spider.platform == '8chan':
-                self.df['timestamp'] = pd.to_datetime(self.df['timestamp'])
-                self.df['timestamp'] = self.df['timestamp'].dt.tz_localize(tz='UTC')  # 8chan timestamps are UTC
-            utilities.process_and_commit_from_df(self.df, platform_obj)
+        df['platform'] = spider.platform
+        platform_obj = utilities.dimensions.platform(spider.platform)
+        if spider.platform == '8chan':
+            df['timestamp'] = pd.to_datetime(df['timestamp'])
+            df['timestamp'] = df['timestamp'].dt.tz_localize(tz='UTC')  # 8chan timestamps are UTC
+        utilities.process_and_commit_from_df(df, platform_obj)
+
+    def close_spider(self, spider):
+        try:
+            # Along with the last completed threads, this commits any that were scraped but never marked complete
+            self.flush(spider, list(dict.fromkeys(self.completed_urls + list(self.threads))))
 
         finally:
-            failed_urls = [url for url in self.start_urls if url not in self.scraped_urls]
-            failed_jobs = spider.jobs.filter(url__in=failed_urls)
-            spider.jobs.update(in_progress=False)
-            for job in failed_jobs:
-                job.error_count += 1
-                job.save()
-
-            print('Deleting finished jobs...')
-            finished_jobs = spider.jobs.filter(url__in=self.scraped_urls)
-            threads_to_reprocess = []
-            for job in finished_jobs:
-                if job.job_type == JobType.REVISIT:
-                    threads_to_reprocess.append((job.platform, job.board, job.thread_id))
-            process_replies(threads_to_reprocess)
-            finished_jobs.delete()
+            # Jobs that yielded no posts or hit an error. Each update is a single statement, and only touches the
+            # jobs still held under the spider's lease
+            held = ScrapeJob.objects.filter(leased_until=spider.lease)
+            failed_ids = set(spider.failed_job_ids)
+            failed_ids.update(job.id for job in spider.jobs.values() if job.url not in self.scraped_urls)
+            held.filter(pk__in=failed_ids).update(error_count=F('error_count') + 1)
+            # Release the rest so they can be claimed again without waiting for their leases to run out
+            held.filter(pk__in=spider.jobs).update(leased_until=None)
             print('Done!')
@@ -85,10 +85,12 @@ DOWNLOADER_MIDDLEWARES = {
 # Configure item pipelines
 # See https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 ITEM_PIPELINES = {
-    'scrapy_project.pipelines.ArchiveIsPipeline': 100,
     'scrapy_project.pipelines.ScrapyPostPipeline': 300,
 }
 
+# Commit scraped posts once this many threads are complete, rather than all at once when the crawl ends
+THREAD_FLUSH_SIZE = 5
+
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
 # AUTOTHROTTLE_ENABLED = True
@@ -1,11 +1,14 @@
-import scrapy
+from django.utils.dateparse import parse_datetime
 from scrapy import Request
 
-from posts.models import ScrapeJob
+from posts.choices import JobType
+from posts.utilities import thread_states
+from .scrape_job_spider import ScrapeJobSpider
 
 
-class EightKunSpider(scrapy.Spider):
+class EightKunSpider(ScrapeJobSpider):
     name = '8kun_spider'
+    platform = '8kun'
 
     custom_settings = {
         'CONCURRENT_REQUESTS': 10,
@@ -13,20 +16,33 @@ class EightKunSpider(scrapy.Spider):
         'DOWNLOAD_DELAY': 0,
     }
 
+    # Revisits are conditional requests, answered with 304 Not Modified if the thread hasn't changed; 404 means the
+    # thread is gone
+    handle_httpstatus_list = [304, 404]
+
     def __init__(self, *args, **kwargs):
-        self.platform = '8kun'
-        self.jobs = []
-        jobs = kwargs.pop('jobs', [])
-        if jobs:
-            self.jobs = ScrapeJob.objects.filter(pk__in=jobs.split(','))
-            self.jobs.update(in_progress=True)
-            self.start_urls = [job.url for job in self.jobs]
         super(EightKunSpider, self).__init__(*args, **kwargs)
+        # (board, thread ID) -> ThreadState, saved by the pipeline once the thread's new posts are committed
+        self.thread_states = {}
+        if self.jobs:
+            self.thread_states = thread_states(self.platform, [(job.board, job.thread_id)
+                                                               for job in self.jobs.values()])
 
     def start_requests(self):
-        for job in self.jobs:
+        for job in self.jobs.values():
+            state = self.thread_states[(job.board, job.thread_id)]
+            if job.job_type == JobType.NEW:
+                # The thread's OP isn't archived, so it's scraped whole rather than from the last post archived
+                state.etag = state.last_modified_header = state.last_post_id = None
+                state.post_count = 0
+            headers = {}
+            if state.etag:
+                headers['If-None-Match'] = state.etag
+            if state.last_modified_header:
+                headers['If-Modified-Since'] = state.last_modified_header
             yield Request(
                 url=job.url,
+                headers=headers,
                 callback=self.parse,
                 cb_kwargs={
                     'job_id': job.id,
@@ -34,31 +50,56 @@ class EightKunSpider(scrapy.Spider):
             )
 
     def parse(self, response, **kwargs):
-        try:
-            job_id = kwargs.get('job_id')
-            job = self.jobs.get(pk=job_id)
-            if len(response.css('div.post')) == 0:
-                # No data here
-                return
+        job_id = kwargs.get('job_id')
+        job = self.jobs.get(job_id)
+        if job is None:
+            # Our lease on it ran out and it was claimed again
+            return
+        if response.status == 304:
+            # Nothing new since the last visit
+            yield {'thread_complete': True, 'url': job.url}
+            return
+        if response.status == 404:
+            yield {'thread_complete': True, 'url': job.url, 'gone': True}
+            return
+
+        posts = response.css('div.post')
+        if len(posts) == 0:
+            # No data here
+            return
+
+        # Posts are in order, so walk back from the newest one and stop at the last one already archived
+        last_post_id = self.thread_states[(job.board, job.thread_id)].last_post_id or 0
+        new_posts = []
+        for post in reversed(posts):
+            post_no = post.css('a.post_no:nth-of-type(3)::text').get()
+            if post_no is None:
+                post_no = job.thread_id
+            if int(post_no) <= last_post_id:
+                break
+            new_posts.append((post_no, post))
 
-            for post in response.css('div.post'):
-                post_no = post.css('a.post_no:nth-of-type(3)::text').get()
-                if post_no is None:
-                    post_no = job.thread_id
-                yield {
-                        'platform': self.platform,
-                        'name': post.css('span.name::text').get(),
-                        'subject': post.css('span.subject::text').get(),
-                        'timestamp': post.css('time').attrib['datetime'],
-                        'poster_id': post.css('span.poster_id::text').get(),
-                        'board': job.board,
-                        'thread_no': job.thread_id,
-                        'post_no': post_no,
-                        'tripcode': post.css('span.trip::text').get(),
-                        'body_text': post.css('div.body').get(),
-                        'url': job.url
-                      }
+        for post_no, post in reversed(new_posts):
+            yield {
+                    'platform': self.platform,
+                    'name': post.css('span.name::text').get(),
+                    'subject': post.css('span.subject::text').get(),
+                    'timestamp': post.css('time').attrib['datetime'],
+                    'poster_id': post.css('span.poster_id::text').get(),
+                    'board': job.board,
+                    'thread_no': job.thread_id,
+                    'post_no': post_no,
+                    'tripcode': post.css('span.trip::text').get(),
+                    'body_text': post.css('div.body').get(),
+                    'url': job.url
+                  }
 
-        finally:
-            job.in_progress = False
-            job.save()
+        # Lets the pipeline commit the thread, then record what was seen for the next visit
+        yield {
+            'thread_complete': True,
+            'url': job.url,
+            'etag': response.headers.get('ETag', b'').decode() or None,
+            'last_modified_header': response.headers.get('Last-Modified', b'').decode() or None,
+            'last_post_id': int(new_posts[0][0]) if new_posts else last_post_id or None,
+            'last_post_at': parse_datetime(new_posts[0][1].css('time').attrib['datetime']) if new_posts else None,
+        }
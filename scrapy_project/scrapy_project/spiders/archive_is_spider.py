@@ -1,16 +1,16 @@
 from datetime import time
 
-import scrapy
 from scrapy_selenium import SeleniumRequest
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.wait import WebDriverWait
 
-from posts.models import ScrapeJob
+from .scrape_job_spider import ScrapeJobSpider
 
 
-class ArchiveIsSpider(scrapy.Spider):
+class ArchiveIsSpider(ScrapeJobSpider):
     name = 'archive_is_spider'
+    platform = '8chan'
 
     custom_settings = {
         'CONCURRENT_REQUESTS': 3,
@@ -18,18 +18,8 @@ class ArchiveIsSpider(scrapy.Spider):
         'DOWNLOAD_DELAY': 0,
     }
 
-    def __init__(self, *args, **kwargs):
-        self.platform = '8chan'
-        self.jobs = []
-        jobs = kwargs.pop('jobs', [])
-        if jobs:
-            self.jobs = ScrapeJob.objects.filter(pk__in=jobs.split(','))
-            self.jobs.update(in_progress=True)
-            self.start_urls = [job.url for job in self.jobs]
-        super(ArchiveIsSpider, self).__init__(*args, **kwargs)
-
     def start_requests(self):
-        for job in self.jobs:
+        for job in self.jobs.values():
             yield SeleniumRequest(
                 url=job.url,
                 callback=self.parse_result,
@@ -39,9 +29,12 @@ class ArchiveIsSpider(scrapy.Spider):
             )
 
     def parse_result(self, response, **kwargs):
+        job_id = kwargs.get('job_id')
+        job = self.jobs.get(job_id)
+        if job is None:
+            # Our lease on it ran out and it was claimed again
+            return
         try:
-            job_id = kwargs.get('job_id')
-            job = self.jobs.get(pk=job_id)
             driver = response.request.meta['driver']
             try:
                 # Did we get a Captcha redirect?
@@ -83,13 +76,10 @@ class ArchiveIsSpider(scrapy.Spider):
                     'url': job.url
                 }
 
+            # Lets the pipeline commit the thread
+            yield {'thread_complete': True, 'url': job.url}
+
         except Exception as e:
             print('Exception scraping {}/{}...'.format(job.board, job.thread_id))
             print(e)
-            job.error_count += 1
-            job.save()
-            pass
-
-        finally:
-            job.in_progress = False
-            job.save()
+            self.failed_job_ids.add(job.id)
@@ -0,0 +1,28 @@
+import scrapy
+from django.utils.dateparse import parse_datetime
+
+from posts.models import ScrapeJob
+from posts.utilities import renew_scrape_job_leases
+
+
+class ScrapeJobSpider(scrapy.Spider):
+    """
+    Base of the spiders that scrape the ScrapeJobs scrape_posts schedules them with, passed as the `jobs` (comma
+    separated IDs) and `lease` (the claim's leased_until, ISO 8601) spider arguments. Subclasses set `platform`.
+    """
+    platform = None
+
+    def __init__(self, *args, **kwargs):
+        # Job ID -> ScrapeJob. Their state is kept here during the crawl and written in bulk by the pipeline
+        self.jobs = {}
+        self.failed_job_ids = set()
+        # The claim the jobs were scheduled under (see claim_scrape_jobs)
+        self.lease = None
+        jobs = kwargs.pop('jobs', [])
+        lease = kwargs.pop('lease', None)
+        if jobs:
+            # Drop any jobs that were claimed again since, and renew the lease on the rest
+            self.lease, held_ids = renew_scrape_job_leases(jobs.split(','), parse_datetime(lease) if lease else None)
+            self.jobs = {job.id: job for job in ScrapeJob.objects.filter(pk__in=held_ids)}
+            self.start_urls = [job.url for job in self.jobs.values()]
+        super(ScrapeJobSpider, self).__init__(*args, **kwargs)